@@ -8,93 +8,136 @@ import csv
 from datetime import date
 import math
 import re
+import os
+import sys
+import glob
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 
-parser = argparse.ArgumentParser(description='disaggregate a netCDF indicator file')
-parser.add_argument('netcdf', help='a netCDF file to split')
-parser.add_argument('grid', help='a CSV that maps between numbered grid cells and latlon')
+def read_slabs(variable, stat, climo, resolution, timesteps):
+    # reads the [stat, :, climo, :] hyperslab of an indicator variable exactly
+    # once, yielding (output time index, slab) pairs of at most `timesteps`
+    # timesteps each.
+    # for DAILY datasets, skip day 60 - February 29
+    # data as received is on a 366 day calendar, but we can't actually
+    # assign a measurement to February 29 1950 in the database, 
+    # we need to drop this datapoint and "scoot down" all the ones 
+    # after it.
+    if resolution == "year":
+        yield 0, variable[stat, climo, :].reshape(1, -1)
+        return
+    feb29 = 59
+    length = variable.shape[1]
+    for start in range(0, length, timesteps):
+        stop = min(start + timesteps, length)
+        slab = variable[stat, start:stop, climo, :]
+        out_start = start
+        if resolution == "day":
+            if start <= feb29 < stop:
+                print("      Dropping data associated with February 29.")
+                slab = numpy.ma.concatenate((slab[:feb29 - start], slab[feb29 - start + 1:]))
+                if len(slab) == 0:
+                    continue
+            elif start > feb29:
+                out_start = start - 1
+        yield out_start, slab
 
-args=parser.parse_args()
+stats = ['mean', 'sd', 'n', 'min', 'max']
+climo_starts = [1971, 2010, 2040, 2070]
+climo_ends = [2000, 2039, 2069, 2099]
+freq_abbreviations = {"year": "a", "month": "m", "day": "d"}
 
-with Dataset(args.netcdf, "r") as input:
-    
-    #check dataset format - general number and presence of variables
-    expected_variables = ["time.int", "cell", "var_5"]
-    for ev in expected_variables:
-        if ev not in input.variables:
-            raise Exception("Did not find expected variable {}".format(ev))
-    
-    resolution_variables = ["month", "day"]
-
-    indicators = []
-    resolution = "year"
-    for v in input.variables:
-        if v in resolution_variables:
-            if resolution == "year":
-                resolution = v
-            else:
-                raise Exception("Multiple time resolution variables: {}, {}".format(v, resolution))
-        elif not v in expected_variables:
-            indicators.append(v)
-    
-    if len(indicators) == 0:
-        raise Exception("No possible indicator variables found")
-    elif len(indicators) == 1:
-        indicator = indicators[0]
-        print("Indicator is {}".format(indicator))
-    else:
-        raise Exception("Multiple possible indicators found: {}".format(indicators))
-    
-    print("Time resolution is {}".format(resolution))
-
-    print("Resolution is {}".format(resolution))
-    def check_variable_expectations(var_name, length, long_name):
-        #checks that a particular variable has the format we expect.
-        var = input.variables[var_name]
-        if len(var[:]) != length:
-            raise Exception("Unexpected length of {} variable. Expected {}, found {}".format(var_name, length, len(var[:])))
-        if var.long_name != long_name:
-            raise Exception("Unexpected long_name for variable {}. Expected {}, found {}".format(var_name, long_name, var.long_name))
-    
-    check_variable_expectations("var_5", 5, "parameters: 1-mean, 2-sd, 3-n, 4-min, 5-max")
-    check_variable_expectations("time.int", 4, "1:1971-2000 ; 2:2010-2039 ; 3:2040-2069 ; 4:2070-2099")
-    check_variable_expectations("cell", 11794, "Grid cell number")
-    if resolution == "month":
-        check_variable_expectations("month", 12, "calendar month")
-    elif resolution == "day":
-        check_variable_expectations("day", 366, "calendary day: 366 days")
-    
-    
-    #TODO: check that the variable has the axes in the right order!
-    def get_dimension_name(dim):
-        return dim.name
-    indicator_dimensions = list(map(get_dimension_name, input.variables[indicator].get_dims()))
-    expected_indicator_dimensions = ["var_5"]
-    if resolution != "year":
-        expected_indicator_dimensions.append(resolution)
-    expected_indicator_dimensions.append("time.int")
-    expected_indicator_dimensions.append("cell")
-
-    if indicator_dimensions != expected_indicator_dimensions:
-        raise Exception("Variable {} dimensions in unexpected order. Expected {} got {}".format(indicator, expected_indicator_dimensions, indicator_dimensions))
-    
-    input_atts = input.__dict__
-    
-    #get lat and lon info and cell index out of the csv file
-    with open(args.grid) as grid:
-        csv = csv.DictReader(grid)
+gcm_institutions = {
+    "ACCESS1-0": "CSIRO (Commonwealth Scientific and Industrial Research Organisation, Australia), and BOM (Bureau of Meteorology, Australia)",
+    "CanESM2": "CCCma (Canadian Centre for Climate Modelling and Analysis, Victoria, BC, Canada)",
+    "CCSM4": "NCAR (National Center for Atmospheric Research) Boulder, CO, USA",
+    "CNRM-CM5": "CNRM (Centre National de Recherches Meteorologiques, Meteo-France, Toulouse,France) and CERFACS (Centre Europeen de Recherches et de Formation Avancee en Calcul Scientifique, Toulouse, France)",
+    "HadGEM2-ES": "Met Office Hadley Centre, Fitzroy Road, Exeter, Devon, EX1 3PB, UK, (http://www.metoffice.gov.uk)",
+    "MPI-ESM-LR": "Max Planck Institute for Meteorology",
+}
+gcm_institute_ids = {
+    "ACCESS1-0": "CSIRO-BOM",
+    "CanESM2": "CCCma",
+    "CCSM4": "NCAR",
+    "CNRM-CM5": "CNRM-CERFACS",
+    "HadGEM2-ES": "MOHC",
+    "MPI-ESM-LR": "MPI-M",
+}
+
+def days_since_1950(year, month, day):
+    days = date(int(year), int(month), int(day)) - date(1950, 1, 1)
+    days = days.days
+    return days
+
+def time_axes(resolution):
+    # builds the time and climatology_bnds values for every climatology at
+    # this resolution. returns a list of (times, bounds) indexed by climatology
+    axes = []
+    for climo in range(len(climo_starts)):
+        start_year = climo_starts[climo]
+        end_year = climo_ends[climo]
+        mid_year = (start_year + end_year)/2
+        if resolution == "year":
+            times = numpy.array([days_since_1950(mid_year, 7, 2)])
+            bounds = numpy.array([
+                days_since_1950(start_year, 1, 1),
+                days_since_1950(end_year, 12, 31)]).reshape(1, 2)
+        
+        elif resolution == "month":
+            times = []
+            bounds = []
+            month_lengths = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+            for month in range(1, 13):
+                times.append(days_since_1950(mid_year, month, 15))
+                bounds.append(days_since_1950(start_year, month, 1))
+                bounds.append(days_since_1950(end_year, month, month_lengths[month]))
+            times = numpy.array(times)
+            bounds = numpy.array(bounds).reshape(12, 2)
+        
+        elif resolution == "day":
+            times = numpy.array(range(1, 366, 1)) + (days_since_1950(mid_year, 1, 1) - 1)
+            bounds = []
+            for day in range(365):
+                bounds.append(days_since_1950(start_year, 1, 1) + day)
+                bounds.append(days_since_1950(end_year, 1, 1) + day)
+            bounds = numpy.array(bounds).reshape(365, 2)
+        axes.append((times, bounds))
+    return axes
+
+# (row, col) output position of every numbered cell, set by set_cell_index().
+# it is the same for every job, so pool workers share a single copy of it.
+cell_index = None
+shared_cell_index = None
+
+def set_cell_index(index):
+    global cell_index
+    cell_index = index
+
+def attach_cell_index(name, shape):
+    # pool initializer: maps the cell index the parent placed in shared memory
+    global shared_cell_index
+    shared_cell_index = SharedMemory(name=name)
+    set_cell_index(numpy.ndarray(shape, dtype=numpy.int64, buffer=shared_cell_index.buf))
+
+def read_grid(grid_file):
+    # reads lat and lon info and the cell index out of the csv file.
+    # returns the latitude and longitude axes and a (2, cells) array of the
+    # (row, col) output position of each numbered cell
+    with open(grid_file) as grid:
+        reader = csv.DictReader(grid)
         latitudes = set()
         longitudes = set()
         rows = set()
         cols = set()
         index_tuples = []
-    
-        for row in csv:
+
+        for row in reader:
             latitudes.add(float(row["lat"]))
             longitudes.add(float(row["lon"]))
             rows.add(int(row["row"]))
             cols.add(int(row["col"]))
             index_tuples.append((int(row["cell_ind"]),( int(row["row"]), int(row["col"]))))
-    
+
         print("rows: {} cols: {} lats: {} lons: {}".format(len(rows), len(cols), len(latitudes), len(longitudes)))
         rows = list(rows)
         rows.sort()
@@ -103,7 +146,7 @@ with Dataset(args.netcdf, "r") as input:
         cols.sort()
         col_offset = cols[0]
         print("rows runs from {} to {}, cols runs from {} to {}".format(rows[0], rows[-1], cols[0], cols[-1]))
-        
+
         def check_spatial_intervals(axis_set, axis_name):
             axis = list(axis_set)
             axis.sort()
@@ -112,215 +155,343 @@ with Dataset(args.netcdf, "r") as input:
                 if axis[i] - axis[i-1] != interval:
                     raise Exception("Unexpected interval in {} axis between {] and {}".format(axis_name, axis[i], axis[i-1]))
             return numpy.array(axis)
-            
+
         latitudes = check_spatial_intervals(latitudes, "latitude")
         longitudes = check_spatial_intervals(longitudes, "longitudes")
-        
-        def second_element(l):
-            return l[1]
-        
+
         index_tuples.append((0,(0,0))) #dummy entry - data indexing begins at 1
         index_tuples.sort()
         for i in range(len(index_tuples)):
             if index_tuples[i][0] != i:
                 raise Exception("cell index is missing an entry for {}".format(i-1))
-        index_tuples = list(map(second_element, index_tuples))
-    
 
-    # the input files look good, now to split the netCDF
-    # we want indicator[parameter, time, *] to each end up in a separate file.
-    # loop over parameter and time. 
-    var_5 = input.variables["var_5"]
-    stats = ['mean', 'sd', 'n', 'min', 'max']
+        # precompute the output (row, col) position of every numbered cell, so
+        # a whole (time, lat, lon) slab can be filled with a single scatter.
+        # the dummy entry is dropped; position i holds cell number i + 1
+        cell_rows = numpy.array([tup[1][0] for tup in index_tuples[1:]]) - row_offset
+        cell_cols = numpy.array([tup[1][1] for tup in index_tuples[1:]]) - col_offset
+    return latitudes, longitudes, numpy.array([cell_rows, cell_cols], dtype=numpy.int64)
+
+def parse_chunks(chunks):
+    # checks the --chunks option, returning "map", "timeseries", None, or
+    # an explicit time,lat,lon shape as a tuple
+    if chunks is None or chunks in ("map", "timeseries"):
+        return chunks
+    try:
+        shape = tuple(int(c) for c in chunks.split(","))
+    except ValueError:
+        shape = ()
+    if len(shape) != 3 or min(shape) < 1:
+        raise ValueError("Expected map, timeseries, or a time,lat,lon chunk shape, got {}".format(chunks))
+    return shape
+
+def chunk_shape(chunks, timelen, nlat, nlon):
+    # translates the parsed --chunks option into a chunk shape for the
+    # indicator variable, or None to let netCDF decide
+    if chunks is None:
+        return None
+    elif chunks == "map":
+        # ncWMS reads one timestep of the whole grid at a time
+        return (1, nlat, nlon)
+    elif chunks == "timeseries":
+        # timeseries read every timestep of a small block of cells
+        return (timelen, min(16, nlat), min(16, nlon))
+    return tuple(min(c, d) for c, d in zip(chunks, (timelen, nlat, nlon)))
+
+def plan_outputs(netcdf, grid_file, latitudes, longitudes, max_memory, layout):
+    # checks that an input file has the format we expect, and returns a job 
+    # for write_output() for each statistic and climatology in it
+    with Dataset(netcdf, "r") as input:
     
-    time_int = input.variables["time.int"]
-    climo_starts = [1971, 2010, 2040, 2070]
-    climo_ends = [2000, 2039, 2069, 2099]
+        #check dataset format - general number and presence of variables
+        expected_variables = ["time.int", "cell", "var_5"]
+        for ev in expected_variables:
+            if ev not in input.variables:
+                raise Exception("Did not find expected variable {}".format(ev))
+    
+        resolution_variables = ["month", "day"]
 
-    for stat in range(len(var_5[:])):
-        print("  Now processing {} {}".format(stat, stats[stat]))
-        
-        for climo in range(len(time_int[:])):
-            print ("    Now processing {} {}-{}".format(climo, climo_starts[climo], climo_ends[climo]))
-            
-            freq_abbreviation = {"year": "a", "month": "m", "day": "d"}[resolution]
-            filename = "{}_{}Clim{}_BCCAQv2_{}_historical-{}_{}_{}0101-{}1231_{}.nc".format(indicator, 
-                                              freq_abbreviation,
-                                              stats[stat].capitalize(),
-                                              input_atts["Model"],
-                                              input_atts["RCP scenario"],
-                                              input_atts["Model run"],
-                                              climo_starts[climo],
-                                              climo_ends[climo],
-                                              input_atts["Major drainage"]
-                                              )
-            print("      {}".format(filename))
-            
-            with Dataset(filename, "w", format="NETCDF4") as output:
-                timelen = {"year": 1, "month": 12, "day": 365}[resolution]
-                
-                lat = output.createDimension("lat", len(latitudes))
-                lon = output.createDimension("lon", len(longitudes))
-                time = output.createDimension("time", timelen)
-                bnds = output.createDimension("bnds", 2)
-                
-                lats = output.createVariable("lat", "f8", ("lat"))
-                lats.standard_name = "latitude"
-                lats.long_name = "latitude"
-                lats.units = "degrees_north"
-                lats.axis = "Y"
-                
-                lons = output.createVariable("lon", "f8", ("lon"))
-                lons.standard_name = "longitude"
-                lons.long_name = "longitude"
-                lons.units = "degrees_east"
-                lons.axis = "X"
-                
-                time = output.createVariable("time", "f8", ("time"))
-                time.standard_name = "time"
-                time.long_name = "time"
-                time.units = "days since 1950-01-01"
-                time.axis = "T"
-                time.calendar = "standard"
-                time.climatology = "climatology_bnds"
-                
-                climatology_bnds = output.createVariable("climatology_bnds", "f8", ("time", "bnds"))
-                climatology_bnds.calendar = "standard"
-                climatology_bnds.units = "days since 1950-01-01"
-                
-                indicator_var = output.createVariable(indicator, "f8", ("time", "lat", "lon"), fill_value=32767)
-                indicator_var.standard_name = indicator
-                indicator_var.long_name = input.variables[indicator].long_name
-                indicator_var.units = input.variables[indicator].units
-                
-                lats[:] = latitudes
-                lons[:] = longitudes
-                
-                def days_since_1950(year, month, day):
-                    days = date(int(year), int(month), int(day)) - date(1950, 1, 1)
-                    days = days.days
-                    return days
-                
-                start_year = climo_starts[climo]
-                end_year = climo_ends[climo]
-                mid_year = (start_year + end_year)/2
+        indicators = []
+        resolution = "year"
+        for v in input.variables:
+            if v in resolution_variables:
                 if resolution == "year":
-                    time[:] = numpy.array([days_since_1950(mid_year, 7, 2)])
-                    climatology_bnds[:] = numpy.array([
-                        days_since_1950(start_year, 1, 1),
-                        days_since_1950(end_year, 12, 31)])
-                
-                elif resolution == "month":
-                    times = []
-                    bounds = []
-                    month_lengths = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-                    for month in range(1, 13):
-                        times.append(days_since_1950(mid_year, month, 15))
-                        bounds.append(days_since_1950(start_year, month, 1))
-                        bounds.append(days_since_1950(end_year, month, month_lengths[month]))
-                    time[:] = numpy.array(times)
-                    climatology_bnds[:] = numpy.array(bounds).reshape(timelen, 2)
-                
-                elif resolution == "day":
-                    time[:] = numpy.array(range(1, 366, 1)) + (days_since_1950(mid_year, 1, 1) - 1)
-                    bounds = []
-                    for day in range(365):
-                        bounds.append(days_since_1950(start_year, 1, 1) + day)
-                        bounds.append(days_since_1950(end_year, 1, 1) + day)
-                    climatology_bnds[:] = numpy.array(bounds).reshape(timelen, 2)
-                
-                data = numpy.full((timelen, len(latitudes), len(longitudes)), 32767)
-                
-                #translate data from numbered cells to latitude and longitude
-                if resolution == "year":
-                    slice = input.variables[indicator][:]
-                    slice = slice[stat]
-                    slice = slice[climo]
-                    for i in range(len(index_tuples)):
-                        #skip the fake one
-                        if i > 0:
-                            tup = index_tuples[i]
-                            row = tup[0]
-                            col = tup[1]
-                            datum = slice[i - 1]
-                            data[0, row - row_offset, col - col_offset] = datum
+                    resolution = v
                 else:
-                    for t in range(timelen):
-                        # for DAILY datasets, skip day 60 - February 29
-                        # data as received is on a 366 day calendar, but we can't actually
-                        # assign a measurement to February 29 1950 in the database, 
-                        # we need to drop this datapoint and "scoot down" all the ones 
-                        # after it.
-                        # monthly datasets processed by this code never reach timestamp 60, 
-                        # so their indexes are never translated and no timestamp
-                        # is skipped.
-                        translated_index = -1
-                        if t < 60:
-                            translated_index = t
-                        if t > 60:
-                            translated_index = t-1
-
-                        if translated_index > -1:
-                            slice = input.variables[indicator][:]
-                            slice = slice[stat]
-                            slice = slice[t]
-                            slice = slice[climo]
-                            for i in range(len(index_tuples)):
-                                if i > 0:
-                                    tup = index_tuples[i]
-                                    row = tup[0]
-                                    col = tup[1]
-                                    datum = slice[i - 1]
-                                    data[translated_index, row - row_offset, col - col_offset] = datum
-                        else:
-                            print("      Dropping data associated with February 29.")
-
-                indicator_var[:] = data
-
-                # translate global metadata on input file into PCIC standards
-                # we's just doing the things that will vary by input file here - 
-                # it's expected a lot of the metadata will be filled in later
-                
-                #global data
-                output.climo_start_time = "{}-01-01T00:00:00Z".format(start_year)
-                output.climo_end_time = "{}-12-31T00:00:00Z".format(end_year)
-                output.frequency = "{}Clim{}".format(freq_abbreviation, stats[stat].capitalize())
-                output.domain = input_atts["Major drainage"]
-                output.creation_date = "{}T-00*00:00Z".format(input_atts["Date"])
-                output.title = input_atts["Title"]
-                output.history = "{}: disaggregate-netcdfs.py {} {}".format(date.today(), args.netcdf, args.grid)
-                
-                # GCM model data
-                gcm_prefix = "hydromodel__downscaling__GCM__"
-                run_strings = re.split("[rip]", input_atts["Model run"])
-                output.setncattr("{}realization".format(gcm_prefix), run_strings[1])
-                output.setncattr("{}initialization_method".format(gcm_prefix), run_strings[2])
-                output.setncattr("{}physics_version".format(gcm_prefix), run_strings[3])
-                
-                gcm = input_atts["Model"]
-                output.setncattr("{}model_id".format(gcm_prefix), gcm)
-                gcm_institutions = {
-                    "ACCESS1-0": "CSIRO (Commonwealth Scientific and Industrial Research Organisation, Australia), and BOM (Bureau of Meteorology, Australia)",
-                    "CanESM2": "CCCma (Canadian Centre for Climate Modelling and Analysis, Victoria, BC, Canada)",
-                    "CCSM4": "NCAR (National Center for Atmospheric Research) Boulder, CO, USA",
-                    "CNRM-CM5": "CNRM (Centre National de Recherches Meteorologiques, Meteo-France, Toulouse,France) and CERFACS (Centre Europeen de Recherches et de Formation Avancee en Calcul Scientifique, Toulouse, France)",
-                    "HadGEM2-ES": "Met Office Hadley Centre, Fitzroy Road, Exeter, Devon, EX1 3PB, UK, (http://www.metoffice.gov.uk)",
-                    "MPI-ESM-LR": "Max Planck Institute for Meteorology",
-                }
-                gcm_institute_ids = {
-                    "ACCESS1-0": "CSIRO-BOM",
-                    "CanESM2": "CCCma",
-                    "CCSM4": "NCAR",
-                    "CNRM-CM5": "CNRM-CERFACS",
-                    "HadGEM2-ES": "MOHC",
-                    "MPI-ESM-LR": "MPI-M",
-                }
-                output.setncattr("{}institution".format(gcm_prefix), gcm_institutions[gcm])
-                output.setncattr("{}institute_id".format(gcm_prefix), gcm_institute_ids[gcm])
-                
-                experiment = "historical, {}".format(input_atts["RCP scenario"])
-                output.setncattr("{}experiment".format(gcm_prefix), experiment)
-                output.setncattr("{}experiment_id".format(gcm_prefix), experiment)
+                    raise Exception("Multiple time resolution variables: {}, {}".format(v, resolution))
+            elif not v in expected_variables:
+                indicators.append(v)
+    
+        if len(indicators) == 0:
+            raise Exception("No possible indicator variables found")
+        elif len(indicators) == 1:
+            indicator = indicators[0]
+            print("Indicator is {}".format(indicator))
+        else:
+            raise Exception("Multiple possible indicators found: {}".format(indicators))
     
+        print("Time resolution is {}".format(resolution))
+
+        print("Resolution is {}".format(resolution))
+        def check_variable_expectations(var_name, length, long_name):
+            #checks that a particular variable has the format we expect.
+            var = input.variables[var_name]
+            if len(var[:]) != length:
+                raise Exception("Unexpected length of {} variable. Expected {}, found {}".format(var_name, length, len(var[:])))
+            if var.long_name != long_name:
+                raise Exception("Unexpected long_name for variable {}. Expected {}, found {}".format(var_name, long_name, var.long_name))
+    
+        check_variable_expectations("var_5", 5, "parameters: 1-mean, 2-sd, 3-n, 4-min, 5-max")
+        check_variable_expectations("time.int", 4, "1:1971-2000 ; 2:2010-2039 ; 3:2040-2069 ; 4:2070-2099")
+        check_variable_expectations("cell", 11794, "Grid cell number")
+        if resolution == "month":
+            check_variable_expectations("month", 12, "calendar month")
+        elif resolution == "day":
+            check_variable_expectations("day", 366, "calendary day: 366 days")
+    
+    
+        #TODO: check that the variable has the axes in the right order!
+        def get_dimension_name(dim):
+            return dim.name
+        indicator_dimensions = list(map(get_dimension_name, input.variables[indicator].get_dims()))
+        expected_indicator_dimensions = ["var_5"]
+        if resolution != "year":
+            expected_indicator_dimensions.append(resolution)
+        expected_indicator_dimensions.append("time.int")
+        expected_indicator_dimensions.append("cell")
+
+        if indicator_dimensions != expected_indicator_dimensions:
+            raise Exception("Variable {} dimensions in unexpected order. Expected {} got {}".format(indicator, expected_indicator_dimensions, indicator_dimensions))
+    
+        input_atts = input.__dict__
+
+        # the input files look good, now to split the netCDF
+        # we want indicator[parameter, time, *] to each end up in a separate file.
+        # the time axis and bounds only depend on resolution and climatology, so
+        # they are built once and shared by every output file.
+        axes = time_axes(resolution)
+        
+        # each timestep costs one row of input cells plus one scattered lat/lon grid
+        timestep_bytes = input.variables[indicator].dtype.itemsize * input.variables[indicator].shape[-1] + 8 * len(latitudes) * len(longitudes)
+        timesteps = max(1, max_memory * 1024 * 1024 // timestep_bytes)
+        history = "{}: disaggregate-netcdfs.py {} {}".format(date.today(), netcdf, grid_file)
+        
+        jobs = []
+        for stat in range(len(input.variables["var_5"][:])):
+            for climo in range(len(input.variables["time.int"][:])):
+                filename = "{}_{}Clim{}_BCCAQv2_{}_historical-{}_{}_{}0101-{}1231_{}.nc".format(indicator, 
+                                                  freq_abbreviations[resolution],
+                                                  stats[stat].capitalize(),
+                                                  input_atts["Model"],
+                                                  input_atts["RCP scenario"],
+                                                  input_atts["Model run"],
+                                                  climo_starts[climo],
+                                                  climo_ends[climo],
+                                                  input_atts["Major drainage"]
+                                                  )
+                times, bounds = axes[climo]
+                jobs.append((netcdf, filename, indicator, resolution, stat, climo, 
+                             latitudes, longitudes, times, bounds, timesteps, history, layout))
+    return jobs
+
+def run_job(job):
+    # runs write_output(), reporting failure instead of raising so one bad 
+    # file doesn't stop the rest of a batch. 
+    # returns (input, output, bytes written, uncompressed bytes, error)
+    try:
+        filename, data_bytes = write_output(job)
+        return job[0], filename, os.path.getsize(filename), data_bytes, None
+    except Exception as e:
+        return job[0], job[1], 0, 0, "{}: {}".format(job[1], e)
+
+def write_output(job):
+    # writes the disaggregated file for one statistic and climatology.
+    # opens the input file itself and reads only its own hyperslab, so any
+    # number of these can run side by side in a process pool while the input 
+    # as a whole is still read once.
+    (netcdf, filename, indicator, resolution, stat, climo, latitudes, longitudes,
+     times, bounds, timesteps, history, layout) = job
+    freq_abbreviation = freq_abbreviations[resolution]
+    
+    with Dataset(netcdf, "r") as input, Dataset(filename, "w", format="NETCDF4") as output:
+        input_atts = input.__dict__
+        timelen = len(times)
+        
+        lat = output.createDimension("lat", len(latitudes))
+        lon = output.createDimension("lon", len(longitudes))
+        time = output.createDimension("time", timelen)
+        bnds = output.createDimension("bnds", 2)
+        
+        lats = output.createVariable("lat", "f8", ("lat"))
+        lats.standard_name = "latitude"
+        lats.long_name = "latitude"
+        lats.units = "degrees_north"
+        lats.axis = "Y"
+        
+        lons = output.createVariable("lon", "f8", ("lon"))
+        lons.standard_name = "longitude"
+        lons.long_name = "longitude"
+        lons.units = "degrees_east"
+        lons.axis = "X"
+        
+        time = output.createVariable("time", "f8", ("time"))
+        time.standard_name = "time"
+        time.long_name = "time"
+        time.units = "days since 1950-01-01"
+        time.axis = "T"
+        time.calendar = "standard"
+        time.climatology = "climatology_bnds"
+        
+        climatology_bnds = output.createVariable("climatology_bnds", "f8", ("time", "bnds"))
+        climatology_bnds.calendar = "standard"
+        climatology_bnds.units = "days since 1950-01-01"
+        
+        indicator_var = output.createVariable(indicator, layout["dtype"], ("time", "lat", "lon"), fill_value=32767,
+                                              zlib=layout["complevel"] > 0,
+                                              complevel=layout["complevel"],
+                                              shuffle=layout["shuffle"],
+                                              chunksizes=chunk_shape(layout["chunks"], timelen, len(latitudes), len(longitudes)))
+        indicator_var.standard_name = indicator
+        indicator_var.long_name = input.variables[indicator].long_name
+        indicator_var.units = input.variables[indicator].units
+        
+        lats[:] = latitudes
+        lons[:] = longitudes
+        time[:] = times
+        climatology_bnds[:] = bounds
+        
+        #translate data from numbered cells to latitude and longitude,
+        #streaming the hyperslab through in blocks that fit in memory
+        for start, slab in read_slabs(input.variables[indicator], stat, climo, resolution, timesteps):
+            data = numpy.full((len(slab), len(latitudes), len(longitudes)), 32767.0)
+            data[:, cell_index[0], cell_index[1]] = numpy.ma.filled(slab, 32767)
+            indicator_var[start:start + len(slab)] = data
+
+        # translate global metadata on input file into PCIC standards
+        # we's just doing the things that will vary by input file here - 
+        # it's expected a lot of the metadata will be filled in later
+        
+        #global data
+        output.climo_start_time = "{}-01-01T00:00:00Z".format(climo_starts[climo])
+        output.climo_end_time = "{}-12-31T00:00:00Z".format(climo_ends[climo])
+        output.frequency = "{}Clim{}".format(freq_abbreviation, stats[stat].capitalize())
+        output.domain = input_atts["Major drainage"]
+        output.creation_date = "{}T-00*00:00Z".format(input_atts["Date"])
+        output.title = input_atts["Title"]
+        output.history = history
+        
+        # GCM model data
+        gcm_prefix = "hydromodel__downscaling__GCM__"
+        run_strings = re.split("[rip]", input_atts["Model run"])
+        output.setncattr("{}realization".format(gcm_prefix), run_strings[1])
+        output.setncattr("{}initialization_method".format(gcm_prefix), run_strings[2])
+        output.setncattr("{}physics_version".format(gcm_prefix), run_strings[3])
+        
+        gcm = input_atts["Model"]
+        output.setncattr("{}model_id".format(gcm_prefix), gcm)
+        output.setncattr("{}institution".format(gcm_prefix), gcm_institutions[gcm])
+        output.setncattr("{}institute_id".format(gcm_prefix), gcm_institute_ids[gcm])
+        
+        experiment = "historical, {}".format(input_atts["RCP scenario"])
+        output.setncattr("{}experiment".format(gcm_prefix), experiment)
+        output.setncattr("{}experiment_id".format(gcm_prefix), experiment)
+    return filename, indicator_var.dtype.itemsize * timelen * len(latitudes) * len(longitudes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='disaggregate netCDF indicator files')
+    parser.add_argument('netcdf', nargs='+', help='netCDF files to split, directories containing them, or glob patterns')
+    parser.add_argument('grid', help='a CSV that maps between numbered grid cells and latlon')
+    parser.add_argument('-m', '--max-memory', type=int, default=1024,
+                        help='approximate memory ceiling in MB for data read and scattered at once, per process (default 1024)')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='number of output files to write concurrently (default 1)')
+    parser.add_argument('-z', '--complevel', type=int, default=0, choices=range(10),
+                        help='zlib compression level for the indicator variable, 0 for none (default 0)')
+    parser.add_argument('-s', '--shuffle', action='store_true',
+                        help='apply the shuffle filter before compressing')
+    parser.add_argument('-c', '--chunks',
+                        help='indicator variable chunk shape: "map" for one timestep per chunk, "timeseries" for every timestep of 16x16 cells per chunk, or an explicit time,lat,lon shape')
+    parser.add_argument('--float32', action='store_true',
+                        help='write the indicator variable as float32 instead of float64')
+
+    args=parser.parse_args()
+
+    # checked once here, rather than failing for every output later
+    try:
+        chunks = parse_chunks(args.chunks)
+    except ValueError as e:
+        parser.error(str(e))
+
+    netcdfs = []
+    for arg in args.netcdf:
+        if os.path.isdir(arg):
+            netcdfs.extend(sorted(glob.glob(os.path.join(arg, "*.nc"))))
+        else:
+            # a pattern that matches nothing is kept, so it's reported as a failure
+            netcdfs.extend(sorted(glob.glob(arg)) or [arg])
+
+    # the grid is the same for every input file, so it's only read and checked once
+    latitudes, longitudes, index = read_grid(args.grid)
+    layout = {
+        "dtype": "f4" if args.float32 else "f8",
+        "complevel": args.complevel,
+        "shuffle": args.shuffle,
+        "chunks": chunks,
+    }
+
+    errors = {}
+    outputs = {}
+    written = {}
+    jobs = []
+    for netcdf in netcdfs:
+        print("Checking {}".format(netcdf))
+        errors[netcdf] = []
+        outputs[netcdf] = 0
+        written[netcdf] = 0
+        try:
+            jobs.extend(plan_outputs(netcdf, args.grid, latitudes, longitudes, args.max_memory, layout))
+        except Exception as e:
+            print("  {}".format(e))
+            errors[netcdf].append(str(e))
+
+    def record(result):
+        netcdf, filename, bytes_written, data_bytes, error = result
+        if error:
+            print("      FAILED {}".format(error))
+            errors[netcdf].append(error)
+        else:
+            print("      {}: {} bytes written, compression ratio {:.2f}".format(filename, bytes_written, data_bytes / bytes_written))
+            outputs[netcdf] += 1
+            written[netcdf] += bytes_written
+
+    # every output reads a distinct hyperslab of its input, so each input is 
+    # read once in total no matter how the outputs are spread across processes.
+    if args.processes > 1:
+        shared = SharedMemory(create=True, size=index.nbytes)
+        try:
+            numpy.ndarray(index.shape, dtype=numpy.int64, buffer=shared.buf)[:] = index
+            with Pool(args.processes, attach_cell_index, (shared.name, index.shape)) as pool:
+                for result in pool.imap_unordered(run_job, jobs):
+                    record(result)
+        finally:
+            shared.close()
+            shared.unlink()
+    else:
+        set_cell_index(index)
+        for job in jobs:
+            print("  Now processing {} {} {}-{}".format(job[0], stats[job[4]], climo_starts[job[5]], climo_ends[job[5]]))
+            record(run_job(job))
+
+    print("Summary:")
+    for netcdf in netcdfs:
+        if errors[netcdf]:
+            print("  FAILED {}".format(netcdf))
+            for error in errors[netcdf]:
+                print("    {}".format(error))
+        else:
+            print("  ok     {} ({} files, {} bytes written)".format(netcdf, outputs[netcdf], written[netcdf]))
     
-print("done!")
\ No newline at end of file
+    if any(errors.values()):
+        sys.exit(1)
+    print("done!")
@@ -5,36 +5,58 @@ frequency, experiment, method, and start and end years.
 After scanning all the files in the data directory and sorting them into groups,
 it uses CDO's ensmean command to generate an average file for any "complete" group
 (a group that contains a file for each model/run in the CSV).
-it does not update metadata; you'll have to do that seperately.'''
+it does not update metadata; you'll have to do that seperately.
+
+The global attributes and variable names of each file are kept in a metadata
+catalog, an SQLite file (--catalog). Files already in the catalog are only
+opened again if their size or modification time has changed, so rescanning a
+large directory is quick. Headers that do need to be read can be read by
+several processes at once (-p). The catalog has the same format as the one
+used by pcic12_climos.py, so the two scripts can share one.
+
+Ensemble means can also be calculated by the script itself with numpy
+(--engine numpy) instead of by cdo, which can calculate other statistics
+(--statistics) from the same read of the members. --check compares the
+numpy engine's ensemble means with cdo's without writing any outputs.'''
 import os
-from netCDF4 import Dataset
+import sys
+import tempfile
+import warnings
+import numpy as np
+from netCDF4 import Dataset, default_fillvals
 import re
 from cdo import Cdo
 import argparse
+import json
+import sqlite3
 from csv import DictReader
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-cdo = Cdo()
-parser = argparse.ArgumentParser('Run cdo ensmean on matched sets of climatologies')
-parser.add_argument('ensemble_spec', help='a csV file listing models and runs to include')
-parser.add_argument('ensemble_name', help='string to use as the name of the ensemble in filenames')
-parser.add_argument('indir', metavar='indir', help='a directory containing matching climatologies')
-parser.add_argument('outdir', metavar='outdir', help='directory to output ensemble means to')
-args = parser.parse_args()
-
-indir = args.indir.rstrip('/')
-outdir = args.outdir.rstrip('/')
-
-print("Reading ensemble specification")
-ensemble_spec = []
-with open(args.ensemble_spec) as csvfile:
-    reader = DictReader(csvfile)
-    for row in reader:
-        ensemble_spec.append(row)
-        
-print(ensemble_spec)
+# variables describing the grid and timesteps rather than holding data
+coordinate_variables = ["time", "time_bnds", "lon", "lat", "climatology_bnds"]
+
+# most bytes of data read from all the members at once by the numpy engine
+slab_bytes = 256 * 1024 ** 2
 
-ensembles = {}
-print("Scanning data files...")
+# how each statistic is calculated from a stack of member data, ignoring
+# missing values. Percentiles are given as "p" and a number, like p90.
+statistic_functions = {
+    "mean": lambda stack: np.nanmean(stack, axis=0),
+    "std": lambda stack: np.nanstd(stack, axis=0),
+    "min": lambda stack: np.nanmin(stack, axis=0),
+    "max": lambda stack: np.nanmax(stack, axis=0),
+    "median": lambda stack: np.nanmedian(stack, axis=0),
+}
+
+def statistic_function(statistic):
+    if statistic in statistic_functions:
+        return statistic_functions[statistic]
+    percentile = re.match(r"^p(\d+(?:\.\d+)?)$", statistic)
+    if percentile and float(percentile.group(1)) <= 100:
+        q = float(percentile.group(1))
+        return lambda stack: np.nanpercentile(stack, q, axis=0)
+    raise ValueError("Unknown statistic {}".format(statistic))
 
 #PCIC's metadata system adds a new prefix to metadata attributes when
 #the model described by those attributes is used as input to another
@@ -49,97 +71,456 @@ def find_attribute_prefix(attributes, final):
         if match:
             return match.group(1)
 
-for file in os.listdir(indir):
-    print("Checking {}".format(file))
-    # check metadata in each file, see what group it belongs to.
-    nc = Dataset("{}/{}".format(indir, file), "r")
-    variable = None
-    frequency = None
-    experiment = None
-    method = None
-    startyear = None
-    endyear = None
-    model = None
-    domain = None
-
-    
-    for v in nc.variables:
-        if v not in ["time", "time_bnds", "lon", "lat", "climatology_bnds"]:
-            variable = v
-    
-    globals = nc.__dict__
-    gcm_prefix = find_attribute_prefix(globals, "experiment_id") if not gcm_prefix else gcm_prefix
-    ds_prefix = find_attribute_prefix(globals, "method_id") if not ds_prefix else ds_prefix
-    
-    
-    frequency = globals["frequency"]
-    domain = globals["domain"]
-
-    method = globals["{}method_id".format(ds_prefix)]
-
-    
-    
-    experiment = globals["{}experiment_id".format(gcm_prefix)]
-    experiment = experiment.replace(",", "+") if experiment else None
-    experiment = experiment.replace(" ", "") if experiment else None
-    
-    model = globals["{}model_id".format(gcm_prefix)]
-    run = "r{}i{}p{}".format(globals["{}realization".format(gcm_prefix)],
-                                         globals["{}initialization_method".format(gcm_prefix)],
-                                         globals["{}physics_version".format(gcm_prefix)])
-                                         
-    include_model = None
-    for model_run in ensemble_spec:
-        if model == model_run["model"] and run == model_run["run"]:
-            include_model = True
-            
-    if not include_model:
-        print("  WARNING: Unexpected model-run combination found: {} {}".format(model, run))
-    
-    startmatch = re.match(r'^(\d\d\d\d)-01-01T00:00:00Z$', globals["climo_start_time"])
-    if(startmatch):
-        startyear = startmatch.group(1) + "0101"
-    
-    # end match will accept either December 30 or December 31 - HadGEM uses a
-    # 360 day calendar.
-    endmatch = re.match(r'^(\d\d\d\d)-12-3\dT00:00:00Z$', globals["climo_end_time"])
-    if(endmatch):
-        endyear = endmatch.group(1) + "1231"   
-    
-    if variable and frequency and experiment and method and startyear and endyear and include_model:
-        ensemble = "{}_{}_{}_{}_{}_rXi1p1_{}-{}_{}".format(variable, frequency, method,
-                                                            args.ensemble_name, experiment, 
-                                                            startyear, endyear, domain)
-        if ensemble in ensembles:
-            l = ensembles[ensemble]
-            l.append(file)
-            ensembles[ensemble] = l
-        else:
-            ensembles[ensemble] = [file]
+# read_header and scan_headers are copies of the ones in
+# ../pcic12_ensemble/pcic12_climos.py; each action is a standalone script. The two
+# scripts can share a catalog, so any change to its schema or to when
+# files are read again has to be made to both.
+
+# returns the global attributes and variable names of a file. numpy values
+# are converted to python ones so they can be stored in the catalog as JSON.
+def read_header(path):
+    with Dataset(path, "r") as nc:
+        attributes = {}
+        for att in nc.ncattrs():
+            value = nc.getncattr(att)
+            attributes[att] = value.tolist() if hasattr(value, "tolist") else value
+        return attributes, list(nc.variables)
+
+# brings the catalog up to date with the files in a directory, reading the
+# headers of files that are new or have changed size or modification time
+# since they were catalogued, and forgetting files that are gone. Returns
+# the global attributes and variable names of each file, by filename.
+def scan_headers(directory, catalog_file, processes):
+    catalog = sqlite3.connect(catalog_file)
+    catalog.execute("""CREATE TABLE IF NOT EXISTS headers (
+                           path TEXT PRIMARY KEY,
+                           size INTEGER,
+                           mtime INTEGER,
+                           attributes TEXT,
+                           variables TEXT)""")
+
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files[os.path.abspath(entry.path)] = (entry.name, stat.st_size, stat.st_mtime_ns)
+
+    catalogued = {}
+    for path, size, mtime in catalog.execute("SELECT path, size, mtime FROM headers"):
+        catalogued[path] = (size, mtime)
+    for path in catalogued:
+        if os.path.dirname(path) == os.path.abspath(directory) and path not in files:
+            catalog.execute("DELETE FROM headers WHERE path = ?", (path,))
+
+    stale = [path for path, (name, size, mtime) in files.items() if catalogued.get(path) != (size, mtime)]
+    print("Reading headers of {} new or changed files; {} already catalogued".format(
+        len(stale), len(files) - len(stale)))
+    if processes > 1:
+        with Pool(processes) as pool:
+            headers = pool.map(read_header, stale, chunksize=16)
+    else:
+        headers = [read_header(path) for path in stale]
+    for path, (attributes, variables) in zip(stale, headers):
+        name, size, mtime = files[path]
+        catalog.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+                        (path, size, mtime, json.dumps(attributes), json.dumps(variables)))
+    catalog.commit()
+
+    headers = {}
+    for path, (name, size, mtime) in files.items():
+        attributes, variables = catalog.execute("SELECT attributes, variables FROM headers WHERE path = ?",
+                                                (path,)).fetchone()
+        headers[name] = (json.loads(attributes), json.loads(variables))
+    catalog.close()
+    return headers
+
+# yields index tuples that together cover an array of the given shape, in
+# order, each selecting few enough values that reading them from every member
+# takes no more than max_bytes. Whole rows along the first dimension are
+# taken when possible, since data is usually chunked by timestep.
+def slabs(shape, members, max_bytes):
+    if not shape:
+        yield ()
+        return
+    row_bytes = int(np.prod(shape[1:])) * members * 8
+    if row_bytes <= max_bytes or len(shape) == 1:
+        step = max(1, max_bytes // row_bytes) if row_bytes else shape[0]
+        for i in range(0, shape[0], step):
+            yield (slice(i, min(i + step, shape[0])),)
     else:
-        print("  WARNING: {} is missing some metadata".format(file))
-        if not variable:
-            print("    Variable cannot be determined")
-        if not frequency:
-            print("    Frequency cannot be determined")
-        if not experiment:
-            print("    Experiment cannot be determined")
-        if not method:
-            print("    Method cannot be determined")
-        if not startyear:
-            print("    Start year cannot be determined")
-        if not endyear:
-            print("    End year cannot be determined")
-    nc.close()
-
-print("Generating outputs...")
-for e in ensembles:
-    files = ensembles[e]
-    if len(files) == len(ensemble_spec):
-        print("Generating {}".format(e))
-        cdo.ensmean(input=['{}/{}'.format(indir, f) for f in files], 
-                    output='{}/{}.nc'.format(outdir, e))
+        for i in range(shape[0]):
+            for inner in slabs(shape[1:], members, max_bytes):
+                yield (slice(i, i + 1),) + inner
+
+# checks that the members of an ensemble can be combined: they need the same
+# data variables, with the same dimensions and shapes (so the same number
+# of timesteps), on the same grid. Timestamps aren't compared, because
+# models with different calendars have different ones; like cdo, the output
+# gets the timestamps of the first member.
+def check_members(paths, members):
+    first = members[0]
+    data_variables = [v for v in first.variables if v not in coordinate_variables]
+    for path, nc in zip(paths[1:], members[1:]):
+        variables = [v for v in nc.variables if v not in coordinate_variables]
+        if variables != data_variables:
+            raise ValueError("{} has variables {}, {} has {}".format(
+                paths[0], data_variables, path, variables))
+        for v in data_variables:
+            if nc.variables[v].dimensions != first.variables[v].dimensions or \
+                    nc.variables[v].shape != first.variables[v].shape:
+                raise ValueError("{} in {} has shape {}, in {} {}".format(
+                    v, paths[0], first.variables[v].shape, path, nc.variables[v].shape))
+        for c in ["lat", "lon"]:
+            if c in first.variables and not np.allclose(first.variables[c][:], nc.variables[c][:]):
+                raise ValueError("{} is not on the same grid as {}".format(path, paths[0]))
+    return data_variables
+
+# copies the global attributes, dimensions, and every variable that isn't
+# a statistic to calculate from a member to an output file.
+def copy_header(member, out, data_variables):
+    out.setncatts({att: member.getncattr(att) for att in member.ncattrs()})
+    for name, dim in member.dimensions.items():
+        out.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name, var in member.variables.items():
+        if name in data_variables and var.ndim > 0 and var.dtype.kind in "fiu":
+            continue
+        fill = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+        copy = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+        copy.setncatts({att: var.getncattr(att) for att in var.ncattrs() if att != "_FillValue"})
+        copy[...] = var[...]
+
+# calculates ensemble statistics of the input files with numpy. outputs is
+# a list of (file, statistics) to write. Each data variable is read a slab
+# at a time from all the members, and every statistic for every output is
+# calculated from that one read. The mean keeps the variable's name; other
+# statistics are written as "<variable>_<statistic>", so they can't be
+# mistaken for it. Missing values are ignored, like cdo ensmean;
+# a value missing from every member is missing in the output. Coordinates
+# and attributes are copied from the first member, and data variables are
+# written as floating point, compressed, chunked by timestep. The statistics
+# in each file are listed in its "ensemble_statistics" attribute.
+def numpy_ensmean(input, outputs, complevel=4):
+    members = [Dataset(path, "r") for path in input]
+    files = []
+    try:
+        data_variables = check_members(input, members)
+        first = members[0]
+        for path, statistics in outputs:
+            files.append(Dataset(path, "w"))
+            copy_header(first, files[-1], data_variables)
+            files[-1].setncattr("ensemble_statistics", ",".join(statistics))
+
+        for name in data_variables:
+            var = first.variables[name]
+            if var.ndim == 0 or var.dtype.kind not in "fiu":
+                continue
+            # statistics of integer data aren't integers, so results are always
+            # floating point, with a fill value to match
+            dtype = np.result_type(var.dtype, np.float32)
+            fill = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+            fill = dtype.type(fill if fill is not None and var.dtype.kind == "f"
+                              else default_fillvals[dtype.str[1:]])
+            # values are read unpacked, so they are written unpacked
+            attributes = {att: var.getncattr(att) for att in var.ncattrs()
+                          if att not in ["_FillValue", "scale_factor", "add_offset"]}
+            if "missing_value" in attributes:
+                attributes["missing_value"] = fill
+            chunks = [1] * (var.ndim - 2) + [max(1, min(n, 512)) for n in var.shape[-2:]]
+            results = []
+            for out, (path, statistics) in zip(files, outputs):
+                for statistic in statistics:
+                    if statistic == "mean":
+                        result_name = name
+                    else:
+                        result_name = "{}_{}".format(name, statistic)
+                    result = out.createVariable(result_name, dtype, var.dimensions, fill_value=fill,
+                                                zlib=True, complevel=complevel, chunksizes=chunks)
+                    result.setncatts(attributes)
+                    results.append((result, statistic_function(statistic)))
+
+            for index in slabs(var.shape, len(members), slab_bytes):
+                stack = np.stack([np.ma.filled(nc.variables[name][index].astype(np.float64), np.nan)
+                                  for nc in members])
+                with warnings.catch_warnings():
+                    # values missing from every member are expected
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    for result, function in results:
+                        result[index] = np.ma.masked_invalid(function(stack))
+    finally:
+        for nc in members + files:
+            nc.close()
+
+# calculates the ensemble mean of the input files with both engines and
+# returns the names of the data variables whose means differ, in their
+# values or in which values are missing. Means are compared relative to the
+# largest value in each slab, since rounding in single precision can leave
+# means near zero relatively far apart. cdo writes results with the type of
+# the inputs, so if that's an integer type its means are rounded, and are
+# allowed to be off by half.
+def compare_engines(input, rtol=1e-5):
+    with tempfile.TemporaryDirectory() as tmp:
+        numpy_output = os.path.join(tmp, "numpy.nc")
+        cdo_output = os.path.join(tmp, "cdo.nc")
+        numpy_ensmean(input, [(numpy_output, ["mean"])])
+        Cdo().ensmean(input=input, output=cdo_output)
+        differences = []
+        with Dataset(numpy_output, "r") as numpy_nc, Dataset(cdo_output, "r") as cdo_nc:
+            for name, var in numpy_nc.variables.items():
+                if name in coordinate_variables or var.ndim == 0 or var.dtype.kind not in "fiu":
+                    continue
+                cdo_var = cdo_nc.variables.get(name)
+                if cdo_var is None or cdo_var.shape != var.shape:
+                    differences.append(name)
+                    continue
+                for index in slabs(var.shape, 2, slab_bytes):
+                    ours, theirs = var[index], cdo_var[index]
+                    if cdo_var.dtype.kind in "iu":
+                        atol = 0.5
+                    else:
+                        atol = rtol * (np.ma.max(np.ma.abs(theirs)) if theirs.count() else 0)
+                    if not np.array_equal(np.ma.getmaskarray(ours), np.ma.getmaskarray(theirs)) or \
+                            not np.ma.allclose(ours, theirs, rtol=0, atol=atol):
+                        differences.append(name)
+                        break
+        return differences
+
+# returns the statistics an output file holds, from its
+# "ensemble_statistics" attribute. Files without one were written before
+# the attribute was, and hold just the mean.
+def recorded_statistics(path):
+    with Dataset(path, "r") as nc:
+        if "ensemble_statistics" in nc.ncattrs():
+            return nc.getncattr("ensemble_statistics").split(",")
+    return ["mean"]
+
+# generates the outputs of each (name, outputs, inputs) job, where outputs
+# is a list of (file, statistics) as for numpy_ensmean; the cdo engine only
+# calculates means. With the cdo engine, jobs run on a pool of threads, and
+# the work itself is done by the cdo processes they start. The numpy engine
+# runs jobs on a pool of processes, since the netCDF library can't be used
+# by several threads at once. A job is only started while the input files
+# of all running jobs, its own included, add up to no more than max_bytes,
+# but one job can always run. Jobs whose outputs are all newer than their
+# inputs, and hold the statistics asked for, are skipped unless force is
+# set. Returns the number of jobs that failed; their partial outputs are
+# removed.
+def run_ensmeans(engine, jobs, workers, max_bytes, force):
+    queue = []
+    for name, outputs, inputs in jobs:
+        newest = max(os.path.getmtime(i) for i in inputs)
+        if not force and all(os.path.exists(o) and os.path.getmtime(o) > newest and
+                             set(recorded_statistics(o)) == set(s) for o, s in outputs):
+            print("Skipping {}: up to date".format(name))
+        else:
+            queue.append((name, outputs, inputs, sum(os.path.getsize(i) for i in inputs)))
+
+    if engine == "numpy":
+        executor = ProcessPoolExecutor(workers)
+        ensmean = numpy_ensmean
     else:
-        print("WARNING: {} has only {} files, skipping ensemble value".format(e, len(files)))
-        for f in files:
-            print("  {}".format(f))
\ No newline at end of file
+        executor = ThreadPoolExecutor(workers)
+        cdo = Cdo()
+        def ensmean(input, outputs):
+            for output, statistics in outputs:
+                cdo.ensmean(input=input, output=output)
+                with Dataset(output, "a") as nc:
+                    nc.setncattr("ensemble_statistics", "mean")
+
+    failures = 0
+    running = {}
+    in_use = 0
+    with executor:
+        while queue or running:
+            while queue and len(running) < workers and (not running or in_use + queue[0][3] <= max_bytes):
+                name, outputs, inputs, size = queue.pop(0)
+                print("Generating {}".format(name))
+                # written under temporary names, so an interrupted job doesn't
+                # leave partial outputs that look up to date
+                tmp = [("{}.tmp".format(o), s) for o, s in outputs]
+                running[executor.submit(ensmean, input=inputs, outputs=tmp)] = (name, outputs, tmp, size)
+                in_use += size
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, outputs, tmp, size = running.pop(future)
+                in_use -= size
+                if future.exception():
+                    print("ERROR generating {}: {}".format(name, future.exception()))
+                    failures += 1
+                    # a failed job's partial outputs are of no use to anyone
+                    for t, _ in tmp:
+                        if os.path.exists(t):
+                            os.remove(t)
+                else:
+                    for (t, _), (o, _) in zip(tmp, outputs):
+                        os.replace(t, o)
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Run cdo ensmean on matched sets of climatologies')
+    parser.add_argument('ensemble_spec', help='a csV file listing models and runs to include')
+    parser.add_argument('ensemble_name', help='string to use as the name of the ensemble in filenames')
+    parser.add_argument('indir', metavar='indir', help='a directory containing matching climatologies')
+    parser.add_argument('outdir', metavar='outdir', help='directory to output ensemble means to')
+    parser.add_argument('-c', '--catalog', default=':memory:', help='SQLite file to keep file metadata in between runs (default: none)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of processes reading file metadata (default 1)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of ensemble means to generate at once (default 1)')
+    parser.add_argument('-m', '--max_memory', type=float, help='most GB of input files for the ensemble means being generated at once (default: no limit)')
+    parser.add_argument('-e', '--engine', choices=['cdo', 'numpy'], default='cdo', help='calculate ensemble means with cdo or with numpy (default cdo)')
+    parser.add_argument('-s', '--statistics', default='mean', help='comma-separated statistics to calculate: mean, std, min, max, median, or a percentile like p90 (default mean; others need --engine numpy)')
+    parser.add_argument('--separate', action='store_true', help='write each statistic to its own file instead of all to one')
+    parser.add_argument('--check', type=int, default=0, metavar='N', help='compare the numpy engine\'s means of N ensembles with cdo ensmean\'s and exit, without writing any outputs')
+    parser.add_argument('-f', '--force', action='store_true', help='generate ensemble means even if the output is newer than its inputs')
+    args = parser.parse_args()
+
+    statistics = []
+    for statistic in args.statistics.split(","):
+        try:
+            statistic_function(statistic)
+        except ValueError as e:
+            parser.error(str(e))
+        if statistic not in statistics:
+            statistics.append(statistic)
+    if statistics != ["mean"] and args.engine != "numpy":
+        parser.error("statistics other than the mean need --engine numpy")
+
+    indir = args.indir.rstrip('/')
+    outdir = args.outdir.rstrip('/')
+
+    print("Reading ensemble specification")
+    ensemble_spec = []
+    with open(args.ensemble_spec) as csvfile:
+        reader = DictReader(csvfile)
+        for row in reader:
+            ensemble_spec.append(row)
+            
+    print(ensemble_spec)
+
+    ensembles = {}
+    print("Scanning data files...")
+    headers = scan_headers(indir, args.catalog, args.processes)
+
+    for file in headers:
+        print("Checking {}".format(file))
+        # check metadata in each file, see what group it belongs to.
+        globals, file_variables = headers[file]
+        variable = None
+        frequency = None
+        experiment = None
+        method = None
+        startyear = None
+        endyear = None
+        model = None
+        domain = None
+
+        
+        for v in file_variables:
+            if v not in coordinate_variables:
+                variable = v
+        
+        gcm_prefix = find_attribute_prefix(globals, "experiment_id") if not gcm_prefix else gcm_prefix
+        ds_prefix = find_attribute_prefix(globals, "method_id") if not ds_prefix else ds_prefix
+        
+        
+        frequency = globals["frequency"]
+        domain = globals["domain"]
+
+        method = globals["{}method_id".format(ds_prefix)]
+
+        
+        
+        experiment = globals["{}experiment_id".format(gcm_prefix)]
+        experiment = experiment.replace(",", "+") if experiment else None
+        experiment = experiment.replace(" ", "") if experiment else None
+        
+        model = globals["{}model_id".format(gcm_prefix)]
+        run = "r{}i{}p{}".format(globals["{}realization".format(gcm_prefix)],
+                                             globals["{}initialization_method".format(gcm_prefix)],
+                                             globals["{}physics_version".format(gcm_prefix)])
+                                             
+        include_model = None
+        for model_run in ensemble_spec:
+            if model == model_run["model"] and run == model_run["run"]:
+                include_model = True
+                
+        if not include_model:
+            print("  WARNING: Unexpected model-run combination found: {} {}".format(model, run))
+        
+        startmatch = re.match(r'^(\d\d\d\d)-01-01T00:00:00Z$', globals["climo_start_time"])
+        if(startmatch):
+            startyear = startmatch.group(1) + "0101"
+        
+        # end match will accept either December 30 or December 31 - HadGEM uses a
+        # 360 day calendar.
+        endmatch = re.match(r'^(\d\d\d\d)-12-3\dT00:00:00Z$', globals["climo_end_time"])
+        if(endmatch):
+            endyear = endmatch.group(1) + "1231"   
+        
+        if variable and frequency and experiment and method and startyear and endyear and include_model:
+            ensemble = "{}_{}_{}_{}_{}_rXi1p1_{}-{}_{}".format(variable, frequency, method,
+                                                                args.ensemble_name, experiment, 
+                                                                startyear, endyear, domain)
+            if ensemble in ensembles:
+                l = ensembles[ensemble]
+                l.append(file)
+                ensembles[ensemble] = l
+            else:
+                ensembles[ensemble] = [file]
+        else:
+            print("  WARNING: {} is missing some metadata".format(file))
+            if not variable:
+                print("    Variable cannot be determined")
+            if not frequency:
+                print("    Frequency cannot be determined")
+            if not experiment:
+                print("    Experiment cannot be determined")
+            if not method:
+                print("    Method cannot be determined")
+            if not startyear:
+                print("    Start year cannot be determined")
+            if not endyear:
+                print("    End year cannot be determined")
+
+    print("Generating outputs...")
+    jobs = []
+    for e in ensembles:
+        files = ensembles[e]
+        if len(files) == len(ensemble_spec):
+            # only a file with the mean in it gets the usual name, so existing
+            # outputs are reused and other statistics can't be taken for means
+            if args.separate:
+                groups = [[s] for s in statistics]
+            else:
+                groups = [statistics]
+            outputs = [('{}/{}.nc'.format(outdir, e) if "mean" in g else
+                        '{}/{}_{}.nc'.format(outdir, e, "_".join(g)), g) for g in groups]
+            jobs.append((e, outputs, ['{}/{}'.format(indir, f) for f in files]))
+        else:
+            print("WARNING: {} has only {} files, skipping ensemble value".format(e, len(files)))
+            for f in files:
+                print("  {}".format(f))
+
+    if args.check:
+        differences = 0
+        for name, outputs, inputs in jobs[:args.check]:
+            print("Comparing {}".format(name))
+            try:
+                variables = compare_engines(inputs)
+            except Exception as e:
+                print("ERROR comparing {}: {}".format(name, e))
+                differences += 1
+                continue
+            for v in variables:
+                print("  MISMATCH: {} differs between numpy and cdo".format(v))
+            differences += bool(variables)
+        if differences:
+            sys.exit("{} of {} ensembles differ between numpy and cdo".format(
+                differences, len(jobs[:args.check])))
+        print("{} ensembles match between numpy and cdo".format(len(jobs[:args.check])))
+        sys.exit()
+
+    max_bytes = args.max_memory * 1024 ** 3 if args.max_memory else float("inf")
+    failures = run_ensmeans(args.engine, jobs, args.workers, max_bytes, args.force)
+    if failures:
+        print("ERROR: {} ensemble means could not be generated".format(failures))
+        sys.exit(1)
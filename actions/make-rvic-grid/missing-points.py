@@ -1,57 +1,153 @@
 '''Checks files in a directory to see which, if any, are missing.
-Checks how many outputs are done by each process; reports any process
-with fewer.'''
+
+Given the manifest of pour points written by rvic-queuer.py (rvic_points.csv),
+reads the outlet indexes from every streamflow file in the directory and
+reports each cell in the manifest that has no output. The missing cells are
+written to a new manifest in the same format, which the array job can be
+rerun on.
+
+Without a manifest, checks how many outputs are done by each process; reports
+any process with fewer.'''
 
 import os
 import argparse
 import re
+import csv
+from multiprocessing import Pool
+from netCDF4 import Dataset
+
+# returns the x and y indexes of the outlet in a streamflow file, which are
+# set by RVIC and correspond to the pour point's position in the domain grid.
+# Only the two index variables are read.
+def read_outlet(path):
+    file = os.path.basename(path)
+    try:
+        with Dataset(path, "r") as streamflow:
+            x = int(streamflow.variables["outlet_x_ind"][0])
+            y = int(streamflow.variables["outlet_y_ind"][0])
+            return file, x, y, None
+    except (OSError, KeyError, IndexError) as e:
+        return file, None, None, "{}: {}".format(file, str(e))
+
+# generate the set of processes and number of files each outputs, and
+# report any process with fewer than the most.
+def count_process_outputs(filelist):
+    last_process = -1
+    most_points = 0
+    process_finder = r'_process(\d*)_point'
+    processes = {}
+    missing = False
 
-parser = argparse.ArgumentParser('Check a directory of RVIC outputs for missing outputs')
-parser.add_argument('directory', help='a folder containing RVIC outputs')
-args = parser.parse_args()
-
-filelist = os.listdir(args.directory)
-
-print("Checking {} files in {}".format(len(filelist), args.directory))
-
-# generate the set of processes and number of files each output
-processes = {}
-last_process = -1
-most_points = 0
-process_finder = r'_process(\d*)_point'
-processes = {}
-missing = False
-
-for file in filelist:
-    process = re.search(process_finder, file)
-    if process:
-        procnum = int(process.group(1))
-        last_process = max(procnum, last_process)
-        if procnum in processes:
-            processes[procnum] = processes[procnum] + 1
+    for file in filelist:
+        process = re.search(process_finder, file)
+        if process:
+            procnum = int(process.group(1))
+            last_process = max(procnum, last_process)
+            if procnum in processes:
+                processes[procnum] = processes[procnum] + 1
+            else:
+                processes[procnum] = 1
+            most_points = max(processes[procnum], most_points)
         else:
-            processes[procnum] = 1
-        most_points = max(processes[procnum], most_points)
+            print("{} is not an RVIC output".format(file))
+
+    if last_process == -1:
+        print("No RVIC data in this directory")
+        missing = True
     else:
-        print("{} is not an RVIC output".format(file))
-
-if last_process == -1:
-    print("No RVIC data in this directory")
-    missing = True
-else:
-    print("Checking {} processes".format(last_process + 1))
-    # check for missing files
-    for i in range(last_process + 1):
-        if i in processes:
-            if processes[i] < most_points:
-                if i == last_process:
-                    print("Final process {} has only {} points".format(i, processes[i]))
-                else:
-                    print("ERROR: Only {} points for process {}. (Expected {})".format(processes[i], i, most_points))
-                    missing = True
-        else:
-            print("ERROR: missing all data from process {}".format(i))
-            missing = True
+        print("Checking {} processes".format(last_process + 1))
+        # check for missing files
+        for i in range(last_process + 1):
+            if i in processes:
+                if processes[i] < most_points:
+                    if i == last_process:
+                        print("Final process {} has only {} points".format(i, processes[i]))
+                    else:
+                        print("ERROR: Only {} points for process {}. (Expected {})".format(processes[i], i, most_points))
+                        missing = True
+            else:
+                print("ERROR: missing all data from process {}".format(i))
+                missing = True
+    return missing
+
+# compare the cells listed in the manifest with the cells found in the
+# directory, and write the missing ones to a new manifest.
+def check_manifest(directory, filelist, manifest, output, num_cells, processes):
+    # the cell's x and y indexes are at the end of its pour point name.
+    cell_finder = re.compile(r'_x(\d+)_y(\d+)$')
+    expected = {}
+    with open(manifest, newline="") as mfile:
+        reader = csv.DictReader(mfile)
+        fields = reader.fieldnames
+        for row in reader:
+            cell = cell_finder.search(row["name"])
+            if not cell:
+                print("ERROR: can't find cell indexes in pour point name {}".format(row["name"]))
+                return True
+            expected[(int(cell.group(1)), int(cell.group(2)))] = row
+    print("Manifest {} lists {} cells".format(manifest, len(expected)))
+
+    paths = [os.path.join(directory, f) for f in filelist if f.endswith(".nc")]
+    found = {}
+    unexpected = []
+    unreadable = []
+    with Pool(processes) as pool:
+        for file, x, y, error in pool.imap_unordered(read_outlet, paths, chunksize=64):
+            if error:
+                unreadable.append(error)
+            elif (x, y) in expected:
+                found[(x, y)] = found.get((x, y), 0) + 1
+            else:
+                unexpected.append("{}: x={} y={}".format(file, x, y))
+
+    for error in sorted(unreadable):
+        print("ERROR reading {}".format(error))
+    for file in sorted(unexpected):
+        print("{} is not a cell in the manifest".format(file))
+    duplicated = sum(1 for count in found.values() if count > 1)
+    if duplicated:
+        print("{} cells have more than one output".format(duplicated))
+
+    # keep the original point numbers, so new outputs don't overwrite or get
+    # confused with old ones, but number processes from 0 so they can be run
+    # as an array job.
+    missing = [row for cell, row in expected.items() if cell not in found]
+    print("Found {} of {} cells; {} missing".format(len(found), len(expected), len(missing)))
+    if not missing:
+        return False
+
+    with open(output, "w", newline="") as ofile:
+        writer = csv.DictWriter(ofile, fieldnames=fields, lineterminator="\n")
+        writer.writeheader()
+        for i, row in enumerate(missing):
+            writer.writerow(dict(row, process=i // num_cells))
+    num_jobs = (len(missing) + num_cells - 1) // num_cells
+    print("Wrote {} missing cells to {}".format(len(missing), output))
+    print("Original processes with missing cells: {}".format(
+        ",".join(str(p) for p in sorted({int(row["process"]) for row in missing}))))
+    print("To rerun them as an array job:")
+    print("    qsub -t 0-{} -v RVIC_POINTS={} rvic_array.pbs".format(num_jobs - 1, os.path.abspath(output)))
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Check a directory of RVIC outputs for missing outputs')
+    parser.add_argument('directory', help='a folder containing RVIC outputs')
+    parser.add_argument('-m', '--manifest', help='the rvic_points.csv manifest written by rvic-queuer.py')
+    parser.add_argument('-o', '--output', default='missing_points.csv', help='manifest of missing cells to write (default missing_points.csv)')
+    parser.add_argument('-n', '--num_cells', type=int, default=1, help='cells per process in the manifest of missing cells (default 1)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of processes reading streamflow files (default 1)')
+    args = parser.parse_args()
+
+    with os.scandir(args.directory) as entries:
+        filelist = [entry.name for entry in entries if entry.is_file()]
+
+    print("Checking {} files in {}".format(len(filelist), args.directory))
+
+    if args.manifest:
+        missing = check_manifest(args.directory, filelist, args.manifest, args.output,
+                                 args.num_cells, args.processes)
+    else:
+        missing = count_process_outputs(filelist)
 
-if not missing:
-    print("No missing data found. Hooray!")
+    if not missing:
+        print("No missing data found. Hooray!")
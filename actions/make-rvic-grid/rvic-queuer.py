@@ -27,10 +27,25 @@ import random
 import string
 import datetime
 import re
+import math
+import heapq
+import os
+import hashlib
+import json
 
 watershed = "Peace"
 environment = "/storage/data/projects/comp_support/climate_explorer_data_prep/hydro/peace_watershed/venv/bin/activate"
 
+# rough model of the time and memory RVIC needs to calculate a single pour
+# point, used by --balance. RVIC builds impulse responses for every cell 
+# upstream of a pour point, so both grow with the upstream area. These are
+# guesses; adjust them after checking the logs of a previous run.
+minutes_per_point = 5
+minutes_per_upstream_cell = 0.005
+walltime_margin = 1.5
+vmem_mb = 12000
+vmem_mb_per_upstream_cell = 0.25
+
 parser = argparse.ArgumentParser('Generate PBS files to queue RVIC calcuations')
 parser.add_argument('-b', '--baseflow', help='a VICGL output ')
 parser.add_argument('-d', '--domain', help='a routing domain file')
@@ -39,6 +54,12 @@ parser.add_argument('-u', '--unit_hydrograph', help='the unit hydrograph file')
 parser.add_argument('-o', '--outdir', help="directory to place the scripts in")
 parser.add_argument('-n', '--num_cells', help="the number of cells to calculate per process")
 parser.add_argument('-r', '--results_dir', help="location to copy results to")
+parser.add_argument('--array', action='store_true',
+                    help="write a single PBS array job and a manifest of pour points instead of a job file per process")
+parser.add_argument('--cache_dir', help="node-local directory where jobs on the same node share one copy of each input file")
+parser.add_argument('--cache_size', type=int, default=200, help="size in GB the input cache may grow to before old files are removed (default 200)")
+parser.add_argument('--balance', action='store_true',
+                    help="group cells into jobs of about equal estimated runtime, instead of in grid order, and size each job's walltime and memory from the estimate")
 args = parser.parse_args()
 
 domain = Dataset(args.domain, "r")
@@ -98,8 +119,7 @@ enddate = date_addition(reference_date, int(time[-1]), calendar)
     
 
     
-process_points = []
-all_processes = []
+watershed_points = []
     
 # step through the watershed gridwise, and group all points that are
 # members of the watershed (ie, have mask = 1 in the domain file)
@@ -110,18 +130,86 @@ all_processes = []
 # "source to sink" model, it can't reuse any earlier calculations.
 # so we can group points that run together pretty much arbitrarily.
 
-for y in range(domain.variables["lat"].size):
-    for x in range(domain.variables["lon"].size):
-        mask = domain.variables["mask"][y][x]
-        if mask > 0: # this cell is in the watershed
-            if len(process_points) == num_cells:
-                all_processes.append(process_points)
-                process_points = []
-            lat = domain.variables["lat"][y]
-            lon = domain.variables["lon"][x]
-            cellname = "{}_{}_{}_x{}_y{}".format(model, experiment, run, x, y)
-            process_points.append("{},{},{}".format(lon, lat, cellname))
-all_processes.append(process_points)
+# the mask, lats, and lons are each read from the domain file once; nonzero()
+# returns the watershed cells in the same row-by-row order as stepping
+# through the grid.
+lats = domain.variables["lat"][:]
+lons = domain.variables["lon"][:]
+mask = np.ma.filled(domain.variables["mask"][:], 0)
+ys, xs = np.nonzero(mask > 0)
+
+for x, y in zip(xs, ys):
+    cellname = "{}_{}_{}_x{}_y{}".format(model, experiment, run, x, y)
+    watershed_points.append("{},{},{}".format(lons[x], lats[y], cellname))
+
+# returns the number of watershed cells upstream of each cell, counting the 
+# cell itself, from the VIC-style flow directions (1-8 clockwise from north)
+# in the routing parameters file. 
+def upstream_cells(flow_direction, mask, lats):
+    north = 1 if lats[-1] > lats[0] else -1
+    dy = {1: north, 2: north, 3: 0, 4: -north, 5: -north, 6: -north, 7: 0, 8: north}
+    dx = {1: 0, 2: 1, 3: 1, 4: 1, 5: 0, 6: -1, 7: -1, 8: -1}
+    ny, nx = mask.shape
+    in_watershed = mask.ravel() > 0
+    
+    # flat index of the cell each cell drains into, or -1 for outlets
+    downstream = np.full(ny * nx, -1)
+    for d in dy:
+        ys, xs = np.nonzero((flow_direction == d) & (mask > 0))
+        to_y = ys + dy[d]
+        to_x = xs + dx[d]
+        inside = (to_y >= 0) & (to_y < ny) & (to_x >= 0) & (to_x < nx)
+        ys, xs, to_y, to_x = ys[inside], xs[inside], to_y[inside], to_x[inside]
+        to_cell = to_y * nx + to_x
+        draining = in_watershed[to_cell]
+        downstream[ys[draining] * nx + xs[draining]] = to_cell[draining]
+    
+    # accumulate counts downstream, starting from the cells nothing drains into
+    counts = in_watershed.astype(int)
+    inflows = np.bincount(downstream[downstream >= 0], minlength=ny * nx)
+    ready = list(np.nonzero(in_watershed & (inflows == 0))[0])
+    while ready:
+        cell = ready.pop()
+        down = downstream[cell]
+        if down >= 0:
+            counts[down] += counts[cell]
+            inflows[down] -= 1
+            if inflows[down] == 0:
+                ready.append(down)
+    return counts.reshape(ny, nx)
+
+# formats minutes as a PBS walltime, hh:mm:ss
+def pbs_walltime(minutes):
+    minutes = math.ceil(minutes)
+    return "{}:{:02d}:00".format(minutes // 60, minutes % 60)
+
+if args.balance:
+    # RVIC can't share work between points, but points with long flow paths
+    # take much longer than points near the edge of the watershed. 
+    # Estimate each point's runtime from its upstream area and hand the most
+    # expensive remaining point to the job with the least estimated runtime
+    # so far, so jobs finish at about the same time.
+    upstream = upstream_cells(np.ma.filled(parameters.variables["Flow_Direction"][:], 0), mask, lats)[ys, xs]
+    point_minutes = minutes_per_point + minutes_per_upstream_cell * upstream
+    num_jobs = math.ceil(len(watershed_points) / num_cells)
+    all_processes = [[] for j in range(num_jobs)]
+    process_minutes = [0] * num_jobs
+    process_vmem = [vmem_mb] * num_jobs
+    jobs = [(0, j) for j in range(num_jobs)]
+    for i in np.argsort(-point_minutes, kind="stable"):
+        minutes, j = heapq.heappop(jobs)
+        all_processes[j].append(watershed_points[i])
+        process_minutes[j] = minutes + point_minutes[i]
+        process_vmem[j] = max(process_vmem[j], vmem_mb + vmem_mb_per_upstream_cell * upstream[i])
+        heapq.heappush(jobs, (process_minutes[j], j))
+    process_minutes = [m * walltime_margin for m in process_minutes]
+    for j in range(num_jobs):
+        print("job {}: {} points, estimated {:.0f} minutes".format(j, len(all_processes[j]), process_minutes[j] / walltime_margin))
+else:
+    all_processes = [watershed_points[i:i + num_cells] for i in range(0, len(watershed_points), num_cells)]
+    #allow 25 minutes per point, which should be plenty
+    process_minutes = [25 * num_cells] * len(all_processes)
+    process_vmem = [vmem_mb] * len(all_processes)
     
 # now we need to write a PBS script for each process. Each one will have
 # a different set of pour points to calculated, but otherwise they all take
@@ -174,6 +262,59 @@ def write_progress(text, pfile):
 def write_file_copy(file, dir, pfile):
     write_progress("Copying {} to {}".format(file, dir), pfile)
     pfile.write("cp {} {}\n".format(file, dir))
+
+# this is a shell function that puts a copy of an input file in $TMPDIR by 
+# way of a cache shared by every job on the node. Cached files are named by
+# their md5 checksum, so a file is only fetched over the network once per 
+# node, even if it is used by several different runs. A lock on each cached 
+# file makes concurrent jobs wait for a single copy rather than each making
+# their own, and the least recently used files that no job is currently 
+# staging are removed when the cache would grow past its size budget.
+# Jobs get hard links to cached files where they can, so a cached file that
+# is still linked from a job's $TMPDIR (its link count is over 1) frees no
+# space when removed, and is kept until that job is done with it.
+stage_function = """stage() {
+    local source=$1 sum=$2
+    local cached=$RVIC_CACHE/$sum
+    mkdir -p $RVIC_CACHE
+    (
+        flock 9
+        if [ ! -f $cached ]; then
+            local size=$(stat -c %s $source)
+            (
+                flock 8
+                for old in $(ls -tr $RVIC_CACHE | grep -v '\\.'); do
+                    local used=$(du -sb --exclude='*.lock' $RVIC_CACHE | cut -f1)
+                    [ $((used + size)) -le $RVIC_CACHE_BYTES ] && break
+                    [ $(stat -c %h $RVIC_CACHE/$old) -eq 1 ] || continue
+                    ( flock -n 7 && rm -f $RVIC_CACHE/$old ) 7>$RVIC_CACHE/$old.lock
+                done
+            ) 8>$RVIC_CACHE/.evict.lock
+            cp $source $cached.partial
+            if ! echo "$sum  $cached.partial" | md5sum -c --status; then
+                echo "$source does not match its checksum; has it changed since the job was generated?"
+                rm -f $cached.partial
+                exit 1
+            fi
+            mv $cached.partial $cached
+        fi
+        touch $cached
+        ln -f $cached $TMPDIR/$(basename $source) 2>/dev/null || cp $cached $TMPDIR/$(basename $source)
+    ) 9>$cached.lock || exit 1
+}"""
+
+# this function returns the md5 checksum of a file, which names it in the cache
+def file_checksum(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+# this function adds commands to stage a file into $TMPDIR through the cache
+def write_file_stage(file, pfile):
+    write_progress("Staging {} to $TMPDIR".format(file), pfile)
+    pfile.write("stage {} {}\n".format(file, checksums[file]))
     
 #writes a blank line to the file. Useful for readability.
 def write_newline(pfile, num=1):
@@ -188,224 +329,298 @@ def file_basename(filepath):
 def write_pbs_argument(argument, value, pfile):
     pfile.write("#PBS -{} {}\n".format(argument, value))
     
-point = 0    
-for proc in range(len(all_processes)):
-    print("writing file {}".format(proc))
-    pbsfile = open("{}/rvic{}.pbs".format(args.outdir, proc), "w+")
-
-    #allow 25 minutes per point, which should be plenty
-    runtime = datetime.timedelta(minutes = 25 * num_cells)
-    
+# writes the PBS directives and the commands that set up $TMPDIR and copy
+# the input files to it. array_size is the number of tasks in an array job,
+# or None for a single job.
+def write_pbs_header(pbsfile, name, minutes, vmem, points, array_size=None):
     # allow 1 GB per point - RVIC outputs plot images and other
     # artifacts that take up a lot of room, even though the
-    # output data itself is only about 7MB
-    memory_size = 60 + num_cells
+    # output data itself is only about 7MB. Without --balance every job
+    # asks for the full num_cells, as it always has; balanced jobs have
+    # different numbers of points, so each asks for its own.
+    memory_size = 60 + (points if args.balance else num_cells)
     
     # write the headers
     pbsfile.write("#!/bin/bash\n")
     pbsfile.write("#PBS -l nodes=1:ppn=1\n")
-    pbsfile.write("#PBS -l vmem=12000mb\n")
-    pbsfile.write("#PBS -l walltime={}\n".format(str(runtime)))
+    pbsfile.write("#PBS -l vmem={}mb\n".format(math.ceil(vmem)))
+    pbsfile.write("#PBS -l walltime={}\n".format(pbs_walltime(minutes)))
     pbsfile.write("#PBS -l file={}gb\n".format(memory_size))
     pbsfile.write("#PBS -o {}logs/\n".format(args.results_dir))
     pbsfile.write("#PBS -e {}logs/\n".format(args.results_dir))
     pbsfile.write("#PBS -m a\n")
-    pbsfile.write("#PBS -N rvic_grid{}\n".format(proc))
+    pbsfile.write("#PBS -N {}\n".format(name))
+    if array_size is not None:
+        pbsfile.write("#PBS -t 0-{}\n".format(array_size - 1))
     
     pbsfile.write("cd $TMPDIR\n")
     pbsfile.write("mkdir rvic_output\n")
     write_newline(pbsfile)
         
-    write_progress("Copying files to $TMPDIR", pbsfile)
-    write_file_copy(args.baseflow, "$TMPDIR", pbsfile)
-    write_file_copy(args.domain, "$TMPDIR", pbsfile)
-    write_file_copy(args.parameters, "$TMPDIR", pbsfile)
-    write_file_copy(args.unit_hydrograph, "$TMPDIR", pbsfile)
+    inputs = [args.baseflow, args.domain, args.parameters, args.unit_hydrograph]
+    if args.cache_dir:
+        pbsfile.write("RVIC_CACHE={}\n".format(args.cache_dir))
+        pbsfile.write("RVIC_CACHE_BYTES={}\n".format(args.cache_size * 1024 ** 3))
+        write_lines(stage_function.split("\n"), pbsfile)
+        write_progress("Staging files to $TMPDIR", pbsfile)
+        for file in inputs:
+            write_file_stage(file, pbsfile)
+    else:
+        write_progress("Copying files to $TMPDIR", pbsfile)
+        for file in inputs:
+            write_file_copy(file, "$TMPDIR", pbsfile)
     write_newline(pbsfile)
-    
-    # each point gets its own config files and RVIC run.
-    # RVIC is theoretically able to do multiple points at once,
-    # but I can't get that to work.
-    # however, since copying the files takes so long (about as long
-    # as generating results), doing multiple points for each file
-    # copy makes sense.
-    for pt in all_processes[proc]:
-
-        write_progress("Generating RVIC configuration files for point {}".format(point), pbsfile)
-        ppoints = ["lons,lats,name"]
-        ppoints.append(pt)
-        write_create_file("pour_points{}.txt".format(point), ppoints, pbsfile)
-        
-        # Now generate the config files. There are two: one for generating the
-        # impulse response functions, the other for actually doing the routing.
-        # There's no non-awkward way to do this.
-    
-        case_dir = "$TMPDIR/rvic_output"
-        caseid = "{}_{}_{}_process{}_point{}".format(model, experiment, run, proc, point)
-        casestr = "{}+{}+{}".format(model, experiment, run)
-        
-        # RVIC names the output impulse response file with the date it
-        # is generated. We can't control the name of this file, which is
-        # annoying when calculating streamflow with the queue, since you 
-        # don't know in advance which day the script will be run, and you need
-        # to pass its filename to the convolution calculations.
-        # This shell command outputs the current date in the format rvic uses
-        # in filenames. It's still possible for this to go wrong,
-        # like if file starts generating before midnight, and finishes
-        # after midnight or something, but it works almost all the time.
-        # Make sure you end up with the number of streamflow files you
-        # expect, just in case.
-        # (It's 7845 for the peace watershed. Consider a quick ls | wc -l 
-        # before starting the assembler script.)
-        today = "$(date +%Y%m%d)"
-    
-        
-        # These configuration options are used by both files:
-        
-        #general options
-        shared_options_cfg = {
-            "log_level": "INFO",
-            "verbose": True,
-            "case_dir": case_dir,
-            "caseid": caseid
-            }
-        
-        #options relating to the watershed domain file
-        domain_cfg = {
-            "file_name": "$TMPDIR/{}".format(file_basename(args.domain)),
-            "longitude_var": "lon",
-            "latitude_var": "lat",
-            "land_mask_var": "mask",
-            "fraction_var": "frac",
-            "area_var": "area"
-            }
 
-        
-        # these configuration options are for the impulse response calculations
-        param_options_cfg = {
-            "clean": True,
-            "gridid": watershed,
-            "temp_dir": "$TMPDIR",
-            "remap": False,
-            "aggregate": False,
-            "agg_pad": 25,
-            "netcdf_format": "NETCDF4",
-            "netcdf_zlib": "False",
-            "netcdf_complevel": 4,
-            "netcdf_sigfigs": None,
-            "subset_days": "",
-            "constrain_fractions": False,
-            "search_for_channel": False
-            }
-        param_options_cfg.update(shared_options_cfg)
+# writes the commands that create the config files for a single pour point,
+# run RVIC on it, and copy the result to the results directory.
+# proc, point, and pt (the "lon,lat,name" pour point line) are written into
+# the script as-is, so they can be either values or shell variables that
+# are filled in when the job runs.
+def write_point(proc, point, pt, pbsfile):
+    write_progress("Generating RVIC configuration files for point {}".format(point), pbsfile)
+    ppoints = ["lons,lats,name"]
+    ppoints.append(pt)
+    write_create_file("pour_points{}.txt".format(point), ppoints, pbsfile)
 
-        
-        #pour points file, created previously
-        pour_points_cfg = { "file_name": "$TMPDIR/pour_points{}.txt".format(point)}
-        
-        uh_box_cfg = {
-            "file_name": "$TMPDIR/{}".format(file_basename(args.unit_hydrograph)),
-            "header_lines": 1
-            }
-
-        routing_cfg = {
-            "file_name": "$TMPDIR/{}".format(file_basename(args.parameters)),
-            "longitude_var": "lon",
-            "latitude_var": "lat",
-            "flow_distance_var": "Flow_Distance",
-            "flow_direction_var": "Flow_Direction",
-            "basin_id_var": "Basin_ID",
-            "velocity": "velocity",
-            "diffusion": "diffusion",
-            "output_interval": 86400,
-            "basin_flowdays": 100,
-            "cell_flowdays": 4,
-            }
-        parameter_config = {}
-        parameter_config["options"] = param_options_cfg
-        parameter_config["pour_points"] = pour_points_cfg
-        parameter_config["uh_box"] = uh_box_cfg
-        parameter_config["routing"] = routing_cfg
-        parameter_config["domain"] = domain_cfg
-        
-        write_create_file("$TMPDIR/params{}.cfg".format(point), multidict_to_config(parameter_config), pbsfile)
-        
-        #these configruation options are for the convolution calculation configuration
-        conv_options_cfg = {
-            "rvic_tag": "1.1.1",
-            "casestr": casestr,
-            "calendar": calendar,
-            "run_type": "drystart",
-            "run_startdate": startdate.strftime("%Y-%m-%d-%H"),
-            "stop_option": "date",
-            "stop_n": -999,
-            "stop_date": enddate.strftime("%Y-%m-%d"),
-            "rest_option": "date",
-            "rest_n": -999,
-            "rest_date": enddate.strftime("%Y-%m-%d"),
-            "rest_ncform": "NETCDF4",
-            }
-        conv_options_cfg.update(shared_options_cfg)
-        
-        history_cfg = {
-            "rvichist_ntapes": 1,
-            "rvichist_mfilt": 100000,
-            "rvichist_ndens": 1,
-            "rvichist_nhtfrq": 1,
-            "rvichist_avgflag": "A",
-            "rvichist_outtype": "array",
-            "rvichist_ncform": "NETCDF4",
-            "rvichist_units": "m3/s"
-            }
-        
-        initial_state_cfg = {"file_name": None}
-        
-        param_filename = "{}/params/{}.rvic.prm.{}.{}.nc".format(case_dir, 
-                                                                     caseid,
-                                                                     watershed,
-                                                                     today)
-        param_file_cfg = {"file_name": param_filename}
-        
-        input_forcings_cfg = {
-            "datl_path": "$TMPDIR",
-            "datl_file": file_basename(args.baseflow),
-            "time_var": "time",
-            "latitude_var": "lat",
-            "datl_liq_flds": "RUNOFF, BASEFLOW",
-            "start": None,
-            "end": None
-            }
-        convolution_config={}
-        convolution_config["options"] = conv_options_cfg
-        convolution_config["history"] = history_cfg
-        convolution_config["domain"] = domain_cfg
-        convolution_config["initial_state"] = initial_state_cfg
-        convolution_config["param_file"] = param_file_cfg
-        convolution_config["input_forcings"] = input_forcings_cfg
-        
-        write_create_file("$TMPDIR/convolve{}.cfg".format(point), multidict_to_config(convolution_config), pbsfile)
+    # Now generate the config files. There are two: one for generating the
+    # impulse response functions, the other for actually doing the routing.
+    # There's no non-awkward way to do this.
 
-        write_newline(pbsfile)
-        write_progress("Running RVIC for point {}".format(point), pbsfile)
-        pbsfile.write("source {}".format(environment))
-        write_progress("Generating impulse response functions", pbsfile)
-        pbsfile.write("rvic parameters $TMPDIR/params{}.cfg".format(point))
-        write_progress("Routing streamflow", pbsfile)
-        pbsfile.write("rvic convolution $TMPDIR/convolve{}.cfg".format(point))
+    case_dir = "$TMPDIR/rvic_output"
+    caseid = "{}_{}_{}_process{}_point{}".format(model, experiment, run, proc, point)
+    casestr = "{}+{}+{}".format(model, experiment, run)
 
-        write_progress("Saving results", pbsfile)
-    
-        casestr_subst = casestr.replace('+', '_')
-        enddate_incremented = enddate + datetime.timedelta(days=1)
-        resultfile = "{}/{}/{}.rvic.h0a.{}.nc".format(case_dir, "hist", caseid, 
-                                                  enddate_incremented.strftime("%Y-%m-%d"))
-        write_file_copy(resultfile, args.results_dir, pbsfile)
+    # RVIC names the output impulse response file with the date it
+    # is generated. We can't control the name of this file, which is
+    # annoying when calculating streamflow with the queue, since you 
+    # don't know in advance which day the script will be run, and you need
+    # to pass its filename to the convolution calculations.
+    # This shell command outputs the current date in the format rvic uses
+    # in filenames. It's still possible for this to go wrong,
+    # like if file starts generating before midnight, and finishes
+    # after midnight or something, but it works almost all the time.
+    # Make sure you end up with the number of streamflow files you
+    # expect, just in case.
+    # (It's 7845 for the peace watershed. Consider a quick ls | wc -l 
+    # before starting the assembler script.)
+    today = "$(date +%Y%m%d)"
+
+
+    # These configuration options are used by both files:
+
+    #general options
+    shared_options_cfg = {
+        "log_level": "INFO",
+        "verbose": True,
+        "case_dir": case_dir,
+        "caseid": caseid
+        }
+
+    #options relating to the watershed domain file
+    domain_cfg = {
+        "file_name": "$TMPDIR/{}".format(file_basename(args.domain)),
+        "longitude_var": "lon",
+        "latitude_var": "lat",
+        "land_mask_var": "mask",
+        "fraction_var": "frac",
+        "area_var": "area"
+        }
+
+
+    # these configuration options are for the impulse response calculations
+    param_options_cfg = {
+        "clean": True,
+        "gridid": watershed,
+        "temp_dir": "$TMPDIR",
+        "remap": False,
+        "aggregate": False,
+        "agg_pad": 25,
+        "netcdf_format": "NETCDF4",
+        "netcdf_zlib": "False",
+        "netcdf_complevel": 4,
+        "netcdf_sigfigs": None,
+        "subset_days": "",
+        "constrain_fractions": False,
+        "search_for_channel": False
+        }
+    param_options_cfg.update(shared_options_cfg)
+
+
+    #pour points file, created previously
+    pour_points_cfg = { "file_name": "$TMPDIR/pour_points{}.txt".format(point)}
+
+    uh_box_cfg = {
+        "file_name": "$TMPDIR/{}".format(file_basename(args.unit_hydrograph)),
+        "header_lines": 1
+        }
+
+    routing_cfg = {
+        "file_name": "$TMPDIR/{}".format(file_basename(args.parameters)),
+        "longitude_var": "lon",
+        "latitude_var": "lat",
+        "flow_distance_var": "Flow_Distance",
+        "flow_direction_var": "Flow_Direction",
+        "basin_id_var": "Basin_ID",
+        "velocity": "velocity",
+        "diffusion": "diffusion",
+        "output_interval": 86400,
+        "basin_flowdays": 100,
+        "cell_flowdays": 4,
+        }
+    parameter_config = {}
+    parameter_config["options"] = param_options_cfg
+    parameter_config["pour_points"] = pour_points_cfg
+    parameter_config["uh_box"] = uh_box_cfg
+    parameter_config["routing"] = routing_cfg
+    parameter_config["domain"] = domain_cfg
+
+    write_create_file("$TMPDIR/params{}.cfg".format(point), multidict_to_config(parameter_config), pbsfile)
+
+    #these configruation options are for the convolution calculation configuration
+    conv_options_cfg = {
+        "rvic_tag": "1.1.1",
+        "casestr": casestr,
+        "calendar": calendar,
+        "run_type": "drystart",
+        "run_startdate": startdate.strftime("%Y-%m-%d-%H"),
+        "stop_option": "date",
+        "stop_n": -999,
+        "stop_date": enddate.strftime("%Y-%m-%d"),
+        "rest_option": "date",
+        "rest_n": -999,
+        "rest_date": enddate.strftime("%Y-%m-%d"),
+        "rest_ncform": "NETCDF4",
+        }
+    conv_options_cfg.update(shared_options_cfg)
+
+    history_cfg = {
+        "rvichist_ntapes": 1,
+        "rvichist_mfilt": 100000,
+        "rvichist_ndens": 1,
+        "rvichist_nhtfrq": 1,
+        "rvichist_avgflag": "A",
+        "rvichist_outtype": "array",
+        "rvichist_ncform": "NETCDF4",
+        "rvichist_units": "m3/s"
+        }
+
+    initial_state_cfg = {"file_name": None}
+
+    param_filename = "{}/params/{}.rvic.prm.{}.{}.nc".format(case_dir, 
+                                                                 caseid,
+                                                                 watershed,
+                                                                 today)
+    param_file_cfg = {"file_name": param_filename}
+
+    input_forcings_cfg = {
+        "datl_path": "$TMPDIR",
+        "datl_file": file_basename(args.baseflow),
+        "time_var": "time",
+        "latitude_var": "lat",
+        "datl_liq_flds": "RUNOFF, BASEFLOW",
+        "start": None,
+        "end": None
+        }
+    convolution_config={}
+    convolution_config["options"] = conv_options_cfg
+    convolution_config["history"] = history_cfg
+    convolution_config["domain"] = domain_cfg
+    convolution_config["initial_state"] = initial_state_cfg
+    convolution_config["param_file"] = param_file_cfg
+    convolution_config["input_forcings"] = input_forcings_cfg
+
+    write_create_file("$TMPDIR/convolve{}.cfg".format(point), multidict_to_config(convolution_config), pbsfile)
+
+    write_newline(pbsfile)
+    write_progress("Running RVIC for point {}".format(point), pbsfile)
+    pbsfile.write("source {}".format(environment))
+    write_progress("Generating impulse response functions", pbsfile)
+    pbsfile.write("rvic parameters $TMPDIR/params{}.cfg".format(point))
+    write_progress("Routing streamflow", pbsfile)
+    pbsfile.write("rvic convolution $TMPDIR/convolve{}.cfg".format(point))
+
+    write_progress("Saving results", pbsfile)
+
+    casestr_subst = casestr.replace('+', '_')
+    enddate_incremented = enddate + datetime.timedelta(days=1)
+    resultfile = "{}/{}/{}.rvic.h0a.{}.nc".format(case_dir, "hist", caseid, 
+                                              enddate_incremented.strftime("%Y-%m-%d"))
+    write_file_copy(resultfile, args.results_dir, pbsfile)
+
+# checksums are only needed to name files in the cache. They're kept in the
+# output directory with each file's size and modification time, so running
+# the queuer again doesn't read the multi-GB baseflow file again unless it
+# has changed.
+if args.cache_dir:
+    checksum_file = "{}/rvic_checksums.json".format(args.outdir)
+    known = {}
+    if os.path.exists(checksum_file):
+        with open(checksum_file) as cfile:
+            known = json.load(cfile)
+    checksums = {}
+    for file in [args.baseflow, args.domain, args.parameters, args.unit_hydrograph]:
+        stat = os.stat(file)
+        key = os.path.abspath(file)
+        if known.get(key, {}).get("size") == stat.st_size and known[key].get("mtime") == stat.st_mtime_ns:
+            checksums[file] = known[key]["md5"]
+        else:
+            print("calculating checksum of {}".format(file))
+            checksums[file] = file_checksum(file)
+            known[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": checksums[file]}
+    with open(checksum_file, "w") as cfile:
+        json.dump(known, cfile, indent=1)
+
+# the manifest lists every pour point and the process that runs it. Array
+# jobs read their points from it; missing-points.py uses it to check results.
+manifest = os.path.abspath("{}/rvic_points.csv".format(args.outdir))
+print("writing manifest {}".format(manifest))
+with open(manifest, "w") as mfile:
+    mfile.write("process,point,lons,lats,name\n")
+    point = 0
+    for proc in range(len(all_processes)):
+        for pt in all_processes[proc]:
+            mfile.write("{},{},{}\n".format(proc, point, pt))
+            point = point + 1
+
+if args.array:
+    # a single array job; task i runs the points of process i. The points
+    # are read from the manifest when the task runs, instead of being
+    # written into the job script. A different manifest, such as the
+    # missing points from an earlier run, can be given in $RVIC_POINTS.
+    print("writing array job for {} processes".format(len(all_processes)))
+    pbsfile = open("{}/rvic_array.pbs".format(args.outdir), "w+")
+    write_pbs_header(pbsfile, "rvic_grid", max(process_minutes), max(process_vmem),
+                     max(len(pts) for pts in all_processes), len(all_processes))
     
-        point = point + 1
+    write_progress("Reading pour points for process $PBS_ARRAYID", pbsfile)
+    pbsfile.write("while IFS=, read -u 3 proc point lon lat name; do\n")
+    write_point("${proc}", "${point}", "${lon},${lat},${name}", pbsfile)
+    write_newline(pbsfile)
+    pbsfile.write("done 3< <(awk -F, -v proc=$PBS_ARRAYID 'NR > 1 && $1 == proc' \"${{RVIC_POINTS:-{}}}\")\n".format(manifest))
     
     write_progress("Process completed.", pbsfile)
     pbsfile.close()
+else:
+    point = 0    
+    for proc in range(len(all_processes)):
+        print("writing file {}".format(proc))
+        pbsfile = open("{}/rvic{}.pbs".format(args.outdir, proc), "w+")
+        write_pbs_header(pbsfile, "rvic_grid{}".format(proc), process_minutes[proc], 
+                         process_vmem[proc], len(all_processes[proc]))
+        
+        # each point gets its own config files and RVIC run.
+        # RVIC is theoretically able to do multiple points at once,
+        # but I can't get that to work.
+        # however, since copying the files takes so long (about as long
+        # as generating results), doing multiple points for each file
+        # copy makes sense.
+        for pt in all_processes[proc]:
+            write_point(proc, point, pt, pbsfile)
+            point = point + 1
+        
+        write_progress("Process completed.", pbsfile)
+        pbsfile.close()
 
 domain.close()
 baseflow.close()
-parameters.close()
+parameters.close()
\ No newline at end of file
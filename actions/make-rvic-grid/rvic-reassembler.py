@@ -1,7 +1,7 @@
 '''
 This is the companion script to rvic-queuer.py Rvic-queuer outputs
 job scripts, each of which can be run on a compute node to calculate
-streamflow for a single grid square in the watershed domain file. 
+streamflow for a single grid square in the watershed domain file.
 
 This script assembles the resulting individual files into a single
 grid file.
@@ -16,96 +16,29 @@ This script does not produce complete PCIC-standards-compliant metadata;
 some additional metadata munging  will be needed afterwards. It does copy
 all relevant (and some irrelevant) metadata from individual streamflow
 files and the baseflow file, so it makes a start on metadata.
+
+Streamflow files can be read by several processes at once (-p); their
+data is passed back to this process, which does all the writing.
+
+Each streamflow file holds one cell's whole timeseries. Writing those
+columns straight into the output would touch every time chunk for every
+cell, so they are gathered in an on-disk buffer and written to the output
+a tile of cells at a time, once every cell in the tile has arrived.
+
+A manifest of the streamflow files in the output is written alongside it
+as each tile is written. With --incremental, an existing output file is
+added to instead of replaced, and only streamflow files that are new or
+have changed size or modification time since they were added are read.
+This can also be used to pick up where an interrupted run left off.
 '''
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 import numpy as np
 import argparse
 import os
-
-parser = argparse.ArgumentParser('Assemble RVIC routed streamflow output into a grid')
-parser.add_argument('-b', '--baseflow', help='VICGL output file used to generate these streamflows')
-parser.add_argument('-d', '--domain', help='a routing domain file')
-parser.add_argument('-s', '--streamflow_dir', help='a directory containing routed streamflow')
-parser.add_argument('-n', '--name', help='name of the file to create')
-args = parser.parse_args()
-            
-# initialize output file
-output = Dataset(args.name, "w")
-
-def grid_object(x, y):
-    return {"x": x, "y": y}
-
-# the baseflow file contains modeled runoff and baseflow over time,
-# based on the rainfall predicted by a model. 
-# the finished output file's time data will match the baseflow,
-# and we will also get metadata about the driving model from it.
-with Dataset(args.baseflow) as baseflow:
-    #output's time data matches the baseflow data
-    print("Initializing time data")
-    timesteps = len(baseflow.dimensions["time"])
-    output.createDimension("time", timesteps)
-    output.createVariable("time", baseflow.variables["time"].dtype, ("time"))
-    output.variables["time"].setncatts(baseflow.variables["time"].__dict__)
-    output.variables["time"][:] = baseflow.variables["time"][:]
-
-    # copy global metadata from the baseflow file 
-    # (this metadata is about the model and run that generated the
-    # input data. It will be prefixed with "hydromodel__")
-    global_atts_copied = 0
-    for att in baseflow.__dict__:
-        hm_att = "hydromodel__{}".format(att)
-        output.setncattr(hm_att,baseflow.getncattr(att))
-        global_atts_copied += 1
-    print("{} hydromodel metadata attributes added".format(global_atts_copied))
-
-# the domain file encodes the shape and characteristics of the watershed
-# the final output file will use the domain file to determine 
-# spatial layout of the watershed.
-with Dataset(args.domain) as domain:
-    # latitude and longitude variables match the domain file
-    latsteps = len(domain.dimensions["lat"])
-    output.createDimension("lat", latsteps)
-    output.createVariable("lat", domain.variables["lat"].dtype, ("lat"))
-    output.variables["lat"].setncatts(domain.variables["lat"].__dict__)
-    output.variables["lat"][:] = domain.variables["lat"][:]
-
-    lonsteps = len(domain.dimensions["lon"])
-    output.createDimension("lon", lonsteps)
-    output.createVariable("lon", domain.variables["lon"].dtype, ("lon"))
-    output.variables["lon"].setncatts(domain.variables["lon"].__dict__)
-    output.variables["lon"][:] = domain.variables["lon"][:]
-    
-    # determine which cells are part of the watershed, and which we need
-    # streamflow data for
-    # First make a list of all the grid cells we need
-    missing_cells = []
-    for y in range(domain.variables["lat"].size):
-        for x in range(domain.variables["lon"].size):
-            mask = domain.variables["mask"][y][x]
-            if mask > 0: # this cell is in the watershed
-                missing_cells.append(grid_object(x, y))
-
-# create streamflow variable, copying metadata from an 
-# arbitrary streamflow file
-# some metadata is not applicable, because it only applies to a
-# single grid cell and not the whole hting, but fixing them is
-# left to update_metadata, not this script.
-# select an arbitrary streamflow output
-with Dataset("{}{}".format(args.streamflow_dir,
-                            os.listdir(args.streamflow_dir)[1]), "r") as sf_meta:
-    sf_var = output.createVariable("streamflow", 
-                                   sf_meta.variables["streamflow"].dtype,
-                                   ("time", "lat", "lon"))
-    sf_var.setncatts(sf_meta.variables["streamflow"].__dict__)
-    output.setncatts(sf_meta.__dict__)
-
-print("Looking for {} cells".format(len(missing_cells)))
-
-files = 0
-
-#for testing, you can subset this (and should)
-filelist = os.listdir(args.streamflow_dir)
+import csv
+import tempfile
+from multiprocessing import Pool
 
 class NoDataFileError(Exception):
     pass
@@ -113,53 +46,251 @@ class NoDataFileError(Exception):
 class WrongDataError(Exception):
     pass
 
-# finally, read each streamflow file and add its data to the grid.        
-for file in filelist:
+# reads a single streamflow file. Returns a tuple of
+# (filename, x, y, streamflow data, error message)
+# errors are returned rather than raised, so that reading can happen in
+# a process pool without one bad file stopping the rest.
+def read_streamflow(path):
+    file = os.path.basename(path)
     try:
-        #todo - make resilient to final slash or not in dir.
         if file.find(".nc") == -1:
             raise NoDataFileError("Not a netCDF file")
-        streamflow = Dataset("{}{}".format(args.streamflow_dir, file))
-    
-        # Make sure the file contains what we're looking for
-        if "outlets" not in streamflow.dimensions:
-            raise WrongDataError("No outlets dimension")
-        if not "outlet_x_ind" in streamflow.variables:
-            raise WrongDataError("Missing outlet_x_ind variable")            
-        if not "outlet_y_ind" in streamflow.variables:
-            raise WrongDataError("Missing outlet_y_ind variable")
-        if not "streamflow" in streamflow.variables:
-            raise WrongDataError("No streamflow data")
-        if len(streamflow.dimensions["outlets"]) > 1:
-            raise WrongDataError("This script assumes one outlet per file")
-        
-        # get the x and y indexes of this file. These are set by RVIC 
-        # and correspond to the x and y positions in the original
-        # grid (from the domain file)
-        x = streamflow.variables["outlet_x_ind"][0]
-        y = streamflow.variables["outlet_y_ind"][0]
-        print("{}. Now processing {}. Detected x: {}, detected y: {}".format(files, file, x, y))
-        grid = grid_object(x, y)
-        
-        if grid in missing_cells:
-            missing_cells.remove(grid)
-        else:
-            raise WrongDataError("x: {}, y: {} is not in this watershed".format(x, y))
-        
-        sf_var[...,y,x] = streamflow.variables["streamflow"][:]
-        
+        with Dataset(path) as streamflow:
+            # Make sure the file contains what we're looking for
+            if "outlets" not in streamflow.dimensions:
+                raise WrongDataError("No outlets dimension")
+            if not "outlet_x_ind" in streamflow.variables:
+                raise WrongDataError("Missing outlet_x_ind variable")
+            if not "outlet_y_ind" in streamflow.variables:
+                raise WrongDataError("Missing outlet_y_ind variable")
+            if not "streamflow" in streamflow.variables:
+                raise WrongDataError("No streamflow data")
+            if len(streamflow.dimensions["outlets"]) > 1:
+                raise WrongDataError("This script assumes one outlet per file")
+
+            # get the x and y indexes of this file. These are set by RVIC
+            # and correspond to the x and y positions in the original
+            # grid (from the domain file)
+            x = int(streamflow.variables["outlet_x_ind"][0])
+            y = int(streamflow.variables["outlet_y_ind"][0])
+            return file, x, y, streamflow.variables["streamflow"][:], None
     except WrongDataError as e:
-        print("ERROR with data in {}: {}".format(file, str(e)))
-        streamflow.close()
+        return file, None, None, None, "ERROR with data in {}: {}".format(file, str(e))
     except NoDataFileError as e:
-        print("ERROR with {}: {}".format(file, str(e)))
+        return file, None, None, None, "ERROR with {}: {}".format(file, str(e))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Assemble RVIC routed streamflow output into a grid')
+    parser.add_argument('-b', '--baseflow', help='VICGL output file used to generate these streamflows')
+    parser.add_argument('-d', '--domain', help='a routing domain file')
+    parser.add_argument('-s', '--streamflow_dir', help='a directory containing routed streamflow')
+    parser.add_argument('-n', '--name', help='name of the file to create')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of processes reading streamflow files (default 1)')
+    parser.add_argument('-t', '--tile_size', type=int, default=16, help='width and height in cells of the tiles written to the output (default 16)')
+    parser.add_argument('--buffer_dir', help='directory for the temporary buffer, which is as large as the output data (default: the output directory)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='add new or changed streamflow files to an existing output file instead of starting over')
+    args = parser.parse_args()
+
+    # the manifest lists every streamflow file whose data is in the output,
+    # with its size and modification time when it was read.
+    manifest_name = "{}.manifest.csv".format(args.name)
+    manifest_fields = ["file", "size", "mtime", "x", "y"]
+    ingested = []
+    appending = args.incremental and os.path.exists(args.name) and os.path.exists(manifest_name)
+    if args.incremental and not appending:
+        print("No existing output and manifest found, starting from scratch")
+
+    if appending:
+        print("Adding to existing output {}".format(args.name))
+        output = Dataset(args.name, "a")
+        with open(manifest_name) as mfile:
+            ingested = list(csv.DictReader(mfile))
+    else:
+        # initialize output file
+        output = Dataset(args.name, "w")
+
+        # the baseflow file contains modeled runoff and baseflow over time,
+        # based on the rainfall predicted by a model.
+        # the finished output file's time data will match the baseflow,
+        # and we will also get metadata about the driving model from it.
+        with Dataset(args.baseflow) as baseflow:
+            #output's time data matches the baseflow data
+            print("Initializing time data")
+            output.createDimension("time", len(baseflow.dimensions["time"]))
+            output.createVariable("time", baseflow.variables["time"].dtype, ("time"))
+            output.variables["time"].setncatts(baseflow.variables["time"].__dict__)
+            output.variables["time"][:] = baseflow.variables["time"][:]
+
+            # copy global metadata from the baseflow file
+            # (this metadata is about the model and run that generated the
+            # input data. It will be prefixed with "hydromodel__")
+            global_atts_copied = 0
+            for att in baseflow.__dict__:
+                hm_att = "hydromodel__{}".format(att)
+                output.setncattr(hm_att,baseflow.getncattr(att))
+                global_atts_copied += 1
+            print("{} hydromodel metadata attributes added".format(global_atts_copied))
+
+    # the domain file encodes the shape and characteristics of the watershed
+    # the final output file will use the domain file to determine
+    # spatial layout of the watershed.
+    with Dataset(args.domain) as domain:
+        latsteps = len(domain.dimensions["lat"])
+        lonsteps = len(domain.dimensions["lon"])
+        if not appending:
+            # latitude and longitude variables match the domain file
+            output.createDimension("lat", latsteps)
+            output.createVariable("lat", domain.variables["lat"].dtype, ("lat"))
+            output.variables["lat"].setncatts(domain.variables["lat"].__dict__)
+            output.variables["lat"][:] = domain.variables["lat"][:]
+
+            output.createDimension("lon", lonsteps)
+            output.createVariable("lon", domain.variables["lon"].dtype, ("lon"))
+            output.variables["lon"].setncatts(domain.variables["lon"].__dict__)
+            output.variables["lon"][:] = domain.variables["lon"][:]
+
+        # determine which cells are part of the watershed, and which we need
+        # streamflow data for: missing_cells[y, x] is True until that cell's
+        # streamflow has been added.
+        missing_cells = np.ma.filled(domain.variables["mask"][:], 0) > 0
+    timesteps = len(output.dimensions["time"])
+
+    # list the streamflow files with their sizes and modification times.
+    file_stats = {}
+    with os.scandir(args.streamflow_dir) as entries:
+        for entry in entries:
+            stat = entry.stat()
+            file_stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    # files already in the output are skipped, unless they've changed since.
+    # (files that have since been deleted stay in the output and manifest.)
+    kept = []
+    for row in ingested:
+        current = file_stats.get(row["file"])
+        if current is None or current == (int(row["size"]), int(row["mtime"])):
+            kept.append(row)
+            missing_cells[int(row["y"]), int(row["x"])] = False
+    print("{} streamflow files already in the output, {} changed since".format(len(kept), len(ingested) - len(kept)))
+    kept_files = set(row["file"] for row in kept)
+
+    #for testing, you can subset filelist (and should)
+    filelist = [os.path.join(args.streamflow_dir, file) for file in file_stats if file not in kept_files]
+
+    # the manifest is rewritten without any changed files, then added to as
+    # tiles are written, so it never lists data that isn't in the output yet.
+    manifest = open(manifest_name + ".tmp", "w")
+    manifest_writer = csv.DictWriter(manifest, manifest_fields)
+    manifest_writer.writeheader()
+    manifest_writer.writerows(kept)
+    manifest.flush()
+    os.replace(manifest_name + ".tmp", manifest_name)
+
+    tile = args.tile_size
+    if appending:
+        sf_var = output.variables["streamflow"]
+        sf_dtype = sf_var.dtype
+        fill_value = sf_var._FillValue
     else:
+        # create streamflow variable, copying metadata from an
+        # arbitrary streamflow file
+        # some metadata is not applicable, because it only applies to a
+        # single grid cell and not the whole hting, but fixing them is
+        # left to update_metadata, not this script.
+        # select an arbitrary streamflow output
+        # the output is chunked to match the tiles it's written in
+        with Dataset([file for file in filelist if file.endswith(".nc")][0], "r") as sf_meta:
+            sf_dtype = sf_meta.variables["streamflow"].dtype
+            fill_value = default_fillvals[sf_dtype.str[1:]]
+            sf_var = output.createVariable("streamflow",
+                                           sf_dtype,
+                                           ("time", "lat", "lon"),
+                                           fill_value=fill_value,
+                                           chunksizes=(min(timesteps, 512), min(tile, latsteps), min(tile, lonsteps)))
+            sf_atts = sf_meta.variables["streamflow"].__dict__
+            sf_atts.pop("_FillValue", None)
+            sf_var.setncatts(sf_atts)
+            output.setncatts(sf_meta.__dict__)
+
+    print("Looking for {} cells".format(missing_cells.sum()))
+
+    files = 0
+
+    # each cell's timeseries is stored contiguously in the buffer until its
+    # tile is written. tile_missing counts the cells each tile still needs,
+    # and pending holds the manifest rows for each tile's new data.
+    buffer_file = tempfile.TemporaryFile(dir=args.buffer_dir or os.path.dirname(os.path.abspath(args.name)))
+    buffer = np.memmap(buffer_file, dtype=sf_dtype, mode="w+", shape=(latsteps, lonsteps, timesteps))
+    received = np.zeros((latsteps, lonsteps), dtype=bool)
+    tiles_y = range(0, latsteps, tile)
+    tiles_x = range(0, lonsteps, tile)
+    tile_missing = np.array([[missing_cells[y:y + tile, x:x + tile].sum() for x in tiles_x] for y in tiles_y])
+    tile_written = np.zeros(tile_missing.shape, dtype=bool)
+    pending = {}
+
+    # writes every timestep of one tile to the output in a single write,
+    # then records the files it came from in the manifest
+    def write_tile(ty, tx):
+        y, x = ty * tile, tx * tile
+        new = received[y:y + tile, x:x + tile]
+        data = np.moveaxis(np.array(buffer[y:y + tile, x:x + tile, :]), 2, 0)
+        if appending:
+            # keep the data already in the output for other cells
+            data[:, ~new] = np.ma.filled(sf_var[:, y:y + tile, x:x + tile], fill_value)[:, ~new]
+        else:
+            data[:, ~new] = fill_value
+        sf_var[:, y:y + tile, x:x + tile] = data
+        output.sync()
+        manifest_writer.writerows(pending.pop((ty, tx), []))
+        manifest.flush()
+        tile_written[ty, tx] = True
+
+    # finally, read each streamflow file and add its data to the grid.
+    # files are read in parallel, but only this process writes to the output.
+    def add_streamflow(result):
+        global files
+        file, x, y, streamflow, error = result
+        if error:
+            print(error)
+            return
+        print("{}. Now processing {}. Detected x: {}, detected y: {}".format(files, file, x, y))
+
+        if 0 <= y < latsteps and 0 <= x < lonsteps and missing_cells[y, x]:
+            missing_cells[y, x] = False
+        else:
+            print("ERROR with data in {}: {}".format(file, "x: {}, y: {} is not in this watershed".format(x, y)))
+            return
+
+        buffer[y, x, :] = np.ma.filled(streamflow, fill_value).reshape(-1)
+        received[y, x] = True
         files += 1
-    
-print("Processed {} streamflow files".format(files))
-if len(missing_cells) > 0:
-    print("WARNING: {} grid cells missing from this watershed".format(len(missing_cells)))
-else:
-    print("Watershed as defined in domain file is complete.")
-            
-output.close()
\ No newline at end of file
+        size, mtime = file_stats[file]
+        pending.setdefault((y // tile, x // tile), []).append(
+            {"file": file, "size": size, "mtime": mtime, "x": x, "y": y})
+
+        tile_missing[y // tile, x // tile] -= 1
+        if tile_missing[y // tile, x // tile] == 0:
+            write_tile(y // tile, x // tile)
+
+    if args.processes > 1:
+        with Pool(args.processes) as pool:
+            for result in pool.imap_unordered(read_streamflow, filelist, chunksize=16):
+                add_streamflow(result)
+    else:
+        for file in filelist:
+            add_streamflow(read_streamflow(file))
+
+    # write any tiles with cells still missing
+    for ty, tx in zip(*np.nonzero(~tile_written)):
+        if received[ty * tile:(ty + 1) * tile, tx * tile:(tx + 1) * tile].any():
+            write_tile(ty, tx)
+    del buffer
+    buffer_file.close()
+    manifest.close()
+
+    print("Processed {} streamflow files".format(files))
+    if missing_cells.any():
+        print("WARNING: {} grid cells missing from this watershed".format(missing_cells.sum()))
+    else:
+        print("Watershed as defined in domain file is complete.")
+
+    output.close()
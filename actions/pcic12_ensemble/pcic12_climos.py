@@ -6,117 +6,246 @@ ensemble mean using the cdo ensmean command.
 This is intended to generate the PCIC12 ensemble means, assuming all
 required climatologies (and no additional climatologies) are present - 
 you'll need to make a directory containing all the needed climatologies.
-It does not do any metadata updates; you'll have to do that separately.'''
+It does not do any metadata updates; you'll have to do that separately.
+File metadata can be kept between runs in an SQLite catalog (--catalog), in
+the same format as ensemble_mean.py's; only new or changed files are opened.'''
 import os
+import sys
 from netCDF4 import Dataset
 import re
 from cdo import Cdo
 import argparse
+import json
+import sqlite3
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-cdo = Cdo()
-parser = argparse.ArgumentParser('Run cdo ensmean on matched sets of 12 climatologies')
-parser.add_argument('indir', metavar='indir', help='a directory containing matching climatologies')
-parser.add_argument('outdir', metavar='outdir', help='directory to output ensemble means to')
-args = parser.parse_args()
-
-indir = args.indir.rstrip('/')
-outdir = args.outdir.rstrip('/')
-
-ensembles = {}
-print("Parsing input files...")
-
-for file in os.listdir(indir):
-    print("Checking {}".format(file))
-    # check metadata in each file, see what group it belongs to.
-    nc = Dataset("{}/{}".format(indir, file), "r")
-    variable = None
-    frequency = None
-    experiment = None
-    method = None
-    startyear = None
-    endyear = None
-    model = None
+# read_header and scan_headers are copies of the ones in
+# ../ensemble_means/ensemble_mean.py; each action is a standalone script. The two
+# scripts can share a catalog, so any change to its schema or to when
+# files are read again has to be made to both.
+
+# returns the global attributes and variable names of a file. numpy values
+# are converted to python ones so they can be stored in the catalog as JSON.
+def read_header(path):
+    with Dataset(path, "r") as nc:
+        attributes = {}
+        for att in nc.ncattrs():
+            value = nc.getncattr(att)
+            attributes[att] = value.tolist() if hasattr(value, "tolist") else value
+        return attributes, list(nc.variables)
+
+# brings the catalog up to date with the files in a directory, reading the
+# headers of files that are new or have changed size or modification time
+# since they were catalogued, and forgetting files that are gone. Returns
+# the global attributes and variable names of each file, by filename.
+def scan_headers(directory, catalog_file, processes):
+    catalog = sqlite3.connect(catalog_file)
+    catalog.execute("""CREATE TABLE IF NOT EXISTS headers (
+                           path TEXT PRIMARY KEY,
+                           size INTEGER,
+                           mtime INTEGER,
+                           attributes TEXT,
+                           variables TEXT)""")
+
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files[os.path.abspath(entry.path)] = (entry.name, stat.st_size, stat.st_mtime_ns)
+
+    catalogued = {}
+    for path, size, mtime in catalog.execute("SELECT path, size, mtime FROM headers"):
+        catalogued[path] = (size, mtime)
+    for path in catalogued:
+        if os.path.dirname(path) == os.path.abspath(directory) and path not in files:
+            catalog.execute("DELETE FROM headers WHERE path = ?", (path,))
+
+    stale = [path for path, (name, size, mtime) in files.items() if catalogued.get(path) != (size, mtime)]
+    print("Reading headers of {} new or changed files; {} already catalogued".format(
+        len(stale), len(files) - len(stale)))
+    if processes > 1:
+        with Pool(processes) as pool:
+            headers = pool.map(read_header, stale, chunksize=16)
+    else:
+        headers = [read_header(path) for path in stale]
+    for path, (attributes, variables) in zip(stale, headers):
+        name, size, mtime = files[path]
+        catalog.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)",
+                        (path, size, mtime, json.dumps(attributes), json.dumps(variables)))
+    catalog.commit()
+
+    headers = {}
+    for path, (name, size, mtime) in files.items():
+        attributes, variables = catalog.execute("SELECT attributes, variables FROM headers WHERE path = ?",
+                                                (path,)).fetchone()
+        headers[name] = (json.loads(attributes), json.loads(variables))
+    catalog.close()
+    return headers
+
+# runs cdo ensmean for each (name, output, inputs) job on a pool of threads;
+# the work itself is done by the cdo processes they start. A job is only
+# started while the input files of all running jobs, its own included, add
+# up to no more than max_bytes, but one job can always run. Outputs newer
+# than all their inputs are skipped unless force is set. Returns the number
+# of jobs that failed; their partial outputs are removed. This is a
+# simpler copy of run_ensmeans in ../ensemble_means/ensemble_mean.py.
+def run_ensmeans(cdo, jobs, workers, max_bytes, force):
+    queue = []
+    for name, output, inputs in jobs:
+        newest = max(os.path.getmtime(i) for i in inputs)
+        if not force and os.path.exists(output) and os.path.getmtime(output) > newest:
+            print("Skipping {}: up to date".format(name))
+        else:
+            queue.append((name, output, inputs, sum(os.path.getsize(i) for i in inputs)))
+
+    def ensmean(output, inputs):
+        # written under a temporary name, so an interrupted job doesn't leave
+        # a partial output that looks up to date
+        tmp = "{}.tmp".format(output)
+        try:
+            cdo.ensmean(input=inputs, output=tmp)
+        except Exception:
+            # a failed job's partial output is of no use to anyone
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, output)
+
+    failures = 0
+    running = {}
+    in_use = 0
+    with ThreadPoolExecutor(workers) as executor:
+        while queue or running:
+            while queue and len(running) < workers and (not running or in_use + queue[0][3] <= max_bytes):
+                name, output, inputs, size = queue.pop(0)
+                print("Generating {}".format(name))
+                running[executor.submit(ensmean, output, inputs)] = (name, size)
+                in_use += size
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, size = running.pop(future)
+                in_use -= size
+                if future.exception():
+                    print("ERROR generating {}: {}".format(name, future.exception()))
+                    failures += 1
+    return failures
+
+if __name__ == '__main__':
+    cdo = Cdo()
+    parser = argparse.ArgumentParser('Run cdo ensmean on matched sets of 12 climatologies')
+    parser.add_argument('indir', metavar='indir', help='a directory containing matching climatologies')
+    parser.add_argument('outdir', metavar='outdir', help='directory to output ensemble means to')
+    parser.add_argument('-c', '--catalog', default=':memory:', help='SQLite file to keep file metadata in between runs (default: none)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of processes reading file metadata (default 1)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of ensemble means to generate at once (default 1)')
+    parser.add_argument('-m', '--max_memory', type=float, help='most GB of input files for the ensemble means being generated at once (default: no limit)')
+    parser.add_argument('-f', '--force', action='store_true', help='generate ensemble means even if the output is newer than its inputs')
+    args = parser.parse_args()
+
+    indir = args.indir.rstrip('/')
+    outdir = args.outdir.rstrip('/')
+
+    ensembles = {}
+    print("Parsing input files...")
+    headers = scan_headers(indir, args.catalog, args.processes)
+
+    for file in headers:
+        print("Checking {}".format(file))
+        # check metadata in each file, see what group it belongs to.
+        globals, file_variables = headers[file]
+        variable = None
+        frequency = None
+        experiment = None
+        method = None
+        startyear = None
+        endyear = None
+        model = None
     
-    for v in nc.variables:
-        if v not in ["time", "time_bnds", "lon", "lat", "climatology_bnds"]:
-            variable = v
+        for v in file_variables:
+            if v not in ["time", "time_bnds", "lon", "lat", "climatology_bnds"]:
+                variable = v
     
-    globals = nc.__dict__
-    frequency = globals["frequency"]
-    method = globals["method_id"]
+        frequency = globals["frequency"]
+        method = globals["method_id"]
     
-    experiment = globals["GCM__experiment_id"]
-    experiment = experiment.replace(",", "+") if experiment else None
-    experiment = experiment.replace(" ", "") if experiment else None
+        experiment = globals["GCM__experiment_id"]
+        experiment = experiment.replace(",", "+") if experiment else None
+        experiment = experiment.replace(" ", "") if experiment else None
     
-    PCIC12_models = {
-        "ACCESS1-0": "r1i1p1",
-        "CanESM2": "r1i1p1",
-        "CCSM4": "r2i1p1",
-        "CNRM-CM5": "r1i1p1",
-        "CSIRO-Mk3-6-0": "r1i1p1",
-        "GFDL-ESM2G": "r1i1p1",
-        "HadGEM2-CC": "r1i1p1",
-        "HadGEM2-ES": "r1i1p1",
-        "inmcm4": "r1i1p1",
-        "MIROC5": "r3i1p1",
-        "MPI-ESM-LR": "r3i1p1",
-        "MRI-CGCM3": "r1i1p1",
-        }
-    model = globals["GCM__model_id"]
-    ensemble_member = "r{}i{}p{}".format(globals["GCM__realization"],
-                                         globals["GCM__initialization_method"],
-                                         globals["GCM__physics_version"])
-    if model not in PCIC12_models:
-        print("  WARNING: Unexpected model found: {}".format(model))
-        model = None
-    elif ensemble_member != PCIC12_models[model]:
-        print("  WARNING: Non-PCIC12 run found: {}".format(ensemble_member))
-        model = None
+        PCIC12_models = {
+            "ACCESS1-0": "r1i1p1",
+            "CanESM2": "r1i1p1",
+            "CCSM4": "r2i1p1",
+            "CNRM-CM5": "r1i1p1",
+            "CSIRO-Mk3-6-0": "r1i1p1",
+            "GFDL-ESM2G": "r1i1p1",
+            "HadGEM2-CC": "r1i1p1",
+            "HadGEM2-ES": "r1i1p1",
+            "inmcm4": "r1i1p1",
+            "MIROC5": "r3i1p1",
+            "MPI-ESM-LR": "r3i1p1",
+            "MRI-CGCM3": "r1i1p1",
+            }
+        model = globals["GCM__model_id"]
+        ensemble_member = "r{}i{}p{}".format(globals["GCM__realization"],
+                                             globals["GCM__initialization_method"],
+                                             globals["GCM__physics_version"])
+        if model not in PCIC12_models:
+            print("  WARNING: Unexpected model found: {}".format(model))
+            model = None
+        elif ensemble_member != PCIC12_models[model]:
+            print("  WARNING: Non-PCIC12 run found: {}".format(ensemble_member))
+            model = None
     
-    startmatch = re.match(r'^(\d\d\d\d)-01-01T00:00:00Z$', globals["climo_start_time"])
-    if(startmatch):
-        startyear = startmatch.group(1) + "0101"
+        startmatch = re.match(r'^(\d\d\d\d)-01-01T00:00:00Z$', globals["climo_start_time"])
+        if(startmatch):
+            startyear = startmatch.group(1) + "0101"
     
-    # end match will accept either December 30 or December 31 - HadGEM uses a
-    # 360 day calendar.
-    endmatch = re.match(r'^(\d\d\d\d)-12-3\dT00:00:00Z$', globals["climo_end_time"])
-    if(endmatch):
-        endyear = endmatch.group(1) + "1231"   
+        # end match will accept either December 30 or December 31 - HadGEM uses a
+        # 360 day calendar.
+        endmatch = re.match(r'^(\d\d\d\d)-12-3\dT00:00:00Z$', globals["climo_end_time"])
+        if(endmatch):
+            endyear = endmatch.group(1) + "1231"   
     
-    if variable and frequency and experiment and method and startyear and endyear and model:
-        ensemble = "{}_{}_{}_PCIC12_{}_rXi1p1_{}-{}_Canada".format(variable, frequency, method,
-                                                            experiment, startyear, endyear)
-        if ensemble in ensembles:
-            l = ensembles[ensemble]
-            l.append(file)
-            ensembles[ensemble] = l
+        if variable and frequency and experiment and method and startyear and endyear and model:
+            ensemble = "{}_{}_{}_PCIC12_{}_rXi1p1_{}-{}_Canada".format(variable, frequency, method,
+                                                                experiment, startyear, endyear)
+            if ensemble in ensembles:
+                l = ensembles[ensemble]
+                l.append(file)
+                ensembles[ensemble] = l
+            else:
+                ensembles[ensemble] = [file]
         else:
-            ensembles[ensemble] = [file]
-    else:
-        print("  WARNING: {} is missing some metadata".format(file))
-        if not variable:
-            print("    Variable cannot be determined")
-        if not frequency:
-            print("    Frequency cannot be determined")
-        if not experiment:
-            print("    Experiment cannot be determined")
-        if not method:
-            print("    Method cannot be determined")
-        if not startyear:
-            print("    Start year cannot be determined")
-        if not endyear:
-            print("    End year cannot be determined")
-    nc.close()
-
-print("Generating outputs...")
-for e in ensembles:
-    files = ensembles[e]
-    if len(files) == 12:
-        print("Generating {}".format(e))
-        cdo.ensmean(input=['{}/{}'.format(indir, f) for f in files], 
-                    output='{}/{}.nc'.format(outdir, e))
-    else:
-        print("WARNING: {} has only {} files, skipping ensemble value".format(e, len(files)))
-        for f in files:
-            print("  {}".format(f))
\ No newline at end of file
+            print("  WARNING: {} is missing some metadata".format(file))
+            if not variable:
+                print("    Variable cannot be determined")
+            if not frequency:
+                print("    Frequency cannot be determined")
+            if not experiment:
+                print("    Experiment cannot be determined")
+            if not method:
+                print("    Method cannot be determined")
+            if not startyear:
+                print("    Start year cannot be determined")
+            if not endyear:
+                print("    End year cannot be determined")
+
+    print("Generating outputs...")
+    jobs = []
+    for e in ensembles:
+        files = ensembles[e]
+        if len(files) == 12:
+            jobs.append((e, '{}/{}.nc'.format(outdir, e), ['{}/{}'.format(indir, f) for f in files]))
+        else:
+            print("WARNING: {} has only {} files, skipping ensemble value".format(e, len(files)))
+            for f in files:
+                print("  {}".format(f))
+
+    max_bytes = args.max_memory * 1024 ** 3 if args.max_memory else float("inf")
+    failures = run_ensmeans(cdo, jobs, args.workers, max_bytes, args.force)
+    if failures:
+        print("ERROR: {} ensemble means could not be generated".format(failures))
+        sys.exit(1)
@@ -0,0 +1,59 @@
+'''This script makes a region index for p2a-precalc.py. It reads the CSV
+matching p2a's region names with the geoserver's names and the CSV of region
+polygons from the geoserver, and writes an SQLite file with one row per
+region:
+
+    'parameter': p2a's name for the region
+    'english_na': the geoserver's name for the region
+    'position': the order of the region in the names file
+    'wkt': the region's polygon
+
+The polygons CSV holds every region's WKT, which is large; with the index,
+p2a-precalc.py reads only the polygons of the regions it is calculating,
+instead of parsing the whole CSV in every job.
+'''
+
+import csv
+import sys
+import sqlite3
+import argparse
+
+parser = argparse.ArgumentParser("Index region names and polygons for p2a-precalc.py")
+parser.add_argument('-n', '--names', help='a csv matching region names with geoserver names')
+parser.add_argument('-p', '--polygons', help='a csv describing regions from a geoserver')
+parser.add_argument('-o', '--outfile', help='the index file to write')
+args = parser.parse_args()
+
+# the WKT of a detailed region may not fit in the csv module's default field size
+csv.field_size_limit(sys.maxsize)
+
+# the first polygon for each geoserver name
+polygons = {}
+with open(args.polygons) as regions:
+    for row in csv.DictReader(regions):
+        polygons.setdefault(row["english_na"], row["the_geom"])
+
+index = sqlite3.connect(args.outfile)
+index.execute("DROP TABLE IF EXISTS regions")
+index.execute("""CREATE TABLE regions (
+                    parameter TEXT PRIMARY KEY,
+                    english_na TEXT,
+                    position INTEGER,
+                    wkt TEXT)""")
+
+indexed = 0
+with open(args.names) as region_names:
+    for position, row in enumerate(csv.DictReader(region_names, quotechar="'")):
+        if row["english_na"] not in polygons:
+            print("No polygon for {} ({})".format(row["parameter"], row["english_na"]))
+            continue
+        # a name listed more than once keeps its first entry
+        added = index.execute("INSERT OR IGNORE INTO regions VALUES (?, ?, ?, ?)",
+                              (row["parameter"], row["english_na"], position,
+                               polygons[row["english_na"]]))
+        indexed += added.rowcount
+
+index.commit()
+index.execute("VACUUM")
+index.close()
+print("Indexed {} regions in {}".format(indexed, args.outfile))
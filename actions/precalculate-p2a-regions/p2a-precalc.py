@@ -32,42 +32,79 @@ question:
 This column describes the calculation:
     'access_time' : when this script was run.
     
-This script is intended to be run on the queue - therefore, while it has a
-dictionary to allow it to parse any of several input regions, only one is
-calculated at a time. 
+This script is intended to be run on the queue. It can calculate one region,
+a comma-separated list of regions, or every region in the names file ("all").
+Each dataset is read once for all the regions being calculated, so one job
+for all the regions does much less I/O than a job per region.
+
+Instead of calling the stats API, stats can be calculated in this script
+(--local_stats) from the netCDF files. Cells are selected the same way the
+stats API selects them: every cell the region touches. The region's cell
+mask is found once per grid rather than for every call; masks are kept for the rest of the
+run, and saved to disk if a --mask_cache directory is given, so later runs
+for the same region can skip finding them. Every timestep of a variable is
+read at once, from the smallest block of the grid that holds all the
+regions, and the stats for all the timesteps and regions are calculated
+from that block. Files whose variables aren't laid out as (time, lat, lon),
+with lat and lon coordinate variables, or whose grid isn't regular, are left
+to the stats API.
+--check compares the two ways of calculating stats for a sample of datasets
+and regions, and fails if they differ, without writing any CSVs. Regions
+with no cells in a dataset's grid get no rows for it.
+
+Stats calls can be made by several worker processes at once (-w). Each worker
+has its own database session with a single connection, so the number of
+workers is capped at the number of connections the database can spare
+(--max_connections). Workers calculate every variable, timestep, and region
+of one dataset at a time, and pass the rows back to this process,
+which writes them to the regions' CSVs as they arrive.
+
+With --incremental, the CSV from the last run for each region is read first.
+Rows for datasets whose modtime in the multimeta file is the same as the
+modtime recorded in the row are carried forward into the new CSV instead of
+being calculated again; only new or reindexed datasets are calculated. Each
+CSV is written with a "<region>.csv.engine" file recording whether it was
+calculated with the stats API or --local_stats; if that doesn't match the
+current run, or is missing, every row of the region is calculated again.
+Datasets with no cells in a region get no rows; they are listed in a
+"<region>.csv.empty" file instead, so they are carried forward too.
 
 It takes three metadata files: 
 
 * a JSON dataset metadata file, the output of the PCEX multimeta query
 * a CSV region metadata file, output from the geoserver
 * a CSV region name file, created for this script
+
+Instead of the two region files, it can take a region index made from them
+by index-regions.py (-x), which only the regions being calculated are read
+from.
 '''
 
 import csv
 import requests
 import json
 import argparse
+import os
+import hashlib
+import tempfile
+import sqlite3
+import warnings
+import itertools
+import sys
+import numpy as np
+import shapely.wkt
+from rasterio import features
+from rasterio.transform import Affine
+from netCDF4 import Dataset
 from datetime import date
 from datetime import datetime
+from multiprocessing import Pool
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from ce.api.stats import stats
 from ce.api.metadata import metadata
-
-parser=argparse.ArgumentParser("Precalculate selected regional variables and output into a CSV")
-parser.add_argument('-n', '--names', help='a csv matching region names with geoserver names')
-parser.add_argument('-p', '--polygons', help='a csv describing regions from a geoserver')
-parser.add_argument('-m', '--multimeta', help='dataset metadata obtained from PCEX /multimeta')
-parser.add_argument('-r', '--region', help='the region to precalculate')
-parser.add_argument('-t', '--tasmean', help='calculate tasmean from tasmin and tasmax',
-                    action='store_const', const=True, default=False)
-parser.add_argument('-f', '--ffd', help='calculate frost free days from frost days', 
-                    action='store_const', const=True, default=False)
-parser.add_argument('-b', '--baseline', default=False, help='YYYY,model include a historical baseline')
-parser.add_argument('-d', '--dsn', help='connection string for a modelmeta database')
-
-args = parser.parse_args()
+from modelmeta import DataFile
 
 # these are the variables plan2adapt needs
 variables = ['tasmean', 'ffd', 'pr', 'prsn', 'gdd', 'hdd', 'cdd']
@@ -104,30 +141,63 @@ scenarios = ['historical, rcp85', 'historical,rcp85',
              ]
 climatologies = [2020, 2050, 2080]
 
-Session = sessionmaker(create_engine(args.dsn))
-sesh = Session()
+# number of timesteps in a dataset of each timescale
+timesteps = {"monthly": 12, "yearly": 1, "seasonal": 4}
 
-if args.tasmean:
-    if "tasmin" not in variables or "tasmax" not in variables:
-        raise Exception("Cannot calculate tasmean without tasmin and tasmax")
-    else:
-        tasmean_data = {"tasmax": [], "tasmin": []}
+# composite variables that can be derived from the rows of other variables
+# instead of being calculated from datasets. Each rule lists the variables
+# the composite is derived from, and how to calculate each stat from a row
+# of each of them. Input rows are matched on the join attributes; other
+# attributes are copied from the first input.
+join_attributes = ['model', 'scenario', 'climatology', 'timescale', 'timeidx', 'op']
+
+derived_variables = {
+    "tasmean": {
+        "inputs": ["tasmax", "tasmin"],
+        "stats": {
+            "min": lambda mx, mn: (mx["min"] + mn["min"]) / 2,
+            "max": lambda mx, mn: (mx["max"] + mn["max"]) / 2,
+            "mean": lambda mx, mn: (mx["mean"] + mn["mean"]) / 2,
+            "median": lambda mx, mn: (mx["median"] + mn["median"]) / 2,
+            "stdev": lambda mx, mn: (mx["stdev"] + mn["stdev"]) / 2
+            }
+        },
+    "ffd": {
+        "inputs": ["fdETCCDI"],
+        "stats": {
+            "min": lambda fd: 365 - fd["max"],
+            "max": lambda fd: 365 - fd["min"],
+            "mean": lambda fd: 365 - fd["mean"],
+            "median": lambda fd: 365 - fd["median"],
+            "stdev": lambda fd: fd["stdev"]
+            }
+        }
+    }
+
+fieldnames = [
+    'unique_id', 
+    'model', 
+    'scenario', 
+    'climatology', 
+    'start_date', 
+    'end_date', 
+    'variable',
+    'region', 
+    'timescale',
+    'timeidx',
+    'timestamp', 
+    'op',
+    'modtime',
+    'min',
+    'max',
+    'mean',
+    'median',
+    'stdev', 
+    'ncells',
+    'units',
+    'access_time'
+    ]
 
-if args.ffd:
-    if 'fdETCCDI' not in variables:
-        raise Exception("Cannot calculate ffd without fdETCCDI")
-    else:
-        ffd_data = []
-        
-if args.baseline:
-    # this argument allows precalculation of data to serve as a historical
-    # baseline - one single model, one single time period - seperately from
-    # the other specified time periods.
-    baseline_datasets = 0
-    baseline_clim = standard_climo_years[args.baseline.split(',')[0]]
-    baseline_model = args.baseline.split(',')[1]
-    print("historical baseline years: {} model: {}".format(baseline_clim, baseline_model))
-    
 #goes through a csv, returning the row where the attribute matches the value
 def find_row_match(csv, att, val):
     for row in csv:
@@ -140,192 +210,539 @@ def year_from_timestring(str):
     d = datetime.strptime(str, '%Y-%m-%dT%H:%M:%SZ')
     return d.year
 
-# look up the name of the region 
-with open(args.names) as region_names:
-    names_csv = csv.DictReader(region_names, quotechar="'")
-    geo_region = find_row_match(names_csv, 'parameter', args.region)['english_na']
-    
-# acquire dataset metadata
-with open(args.multimeta) as multimeta:
-    datasets = json.load(multimeta)
-
-    #acquire region metadata
-    with open(args.polygons) as regions:
-        region_csv = csv.DictReader(regions)
-        wkt = find_row_match(region_csv, "english_na", geo_region)["the_geom"]
-
-    # fetch the WKT for the region.
-    with open('{}.csv'.format(args.region), 'w') as outfile:
-        fieldnames = [
-            'unique_id', 
-            'model', 
-            'scenario', 
-            'climatology', 
-            'start_date', 
-            'end_date', 
-            'variable',
-            'region', 
-            'timescale',
-            'timeidx',
-            'timestamp', 
-            'op',
-            'modtime',
-            'min',
-            'max',
-            'mean',
-            'median',
-            'stdev', 
-            'ncells',
-            'units',
-            'access_time'
-            ]
-        outcsv = csv.DictWriter(outfile, fieldnames)
-        outcsv.writeheader()
+# derives a composite variable from the rows of its inputs with a hash join:
+# the rows of every input but the first are indexed on the join attributes,
+# and each row of the first input is looked up in the indexes. Returns the
+# derived rows and the number of input rows that matched nothing.
+def derive_rows(name, rule, input_rows):
+    def join_key(row):
+        return tuple(str(row[att]) for att in join_attributes)
+
+    first, others = rule["inputs"][0], rule["inputs"][1:]
+    indexes = []
+    for v in others:
+        index = {}
+        for row in input_rows[v]:
+            index.setdefault(join_key(row), []).append(row)
+        indexes.append(index)
+
+    derived = []
+    matched = set()
+    for row in input_rows[first]:
+        key = join_key(row)
+        for inputs in itertools.product([row], *[index.get(key, []) for index in indexes]):
+            matched.add(key)
+            derived_row = dict(inputs[0])
+            derived_row['unique_id'] = "null"
+            derived_row['variable'] = name
+            derived_row['modtime'] = max(r["modtime"] for r in inputs)
+            derived_row['access_time'] = date.today()
+            for stat, calculate in rule["stats"].items():
+                derived_row[stat] = calculate(*inputs)
+            derived.append(derived_row)
+
+    unmatched = sum(1 for v in rule["inputs"] for row in input_rows[v] if join_key(row) not in matched)
+    return derived, unmatched
+
+# each worker has its own database session, whose engine holds a single
+# connection, and its own copy of the names and WKT of the regions being
+# calculated.
+sesh = None
+regions = []
+local_stats = False
+mask_cache = None
+
+def init_worker(dsn, region_wkts, use_local_stats=False, cache_dir=None):
+    global sesh, regions, local_stats, mask_cache
+    engine = create_engine(dsn, pool_size=1, max_overflow=0)
+    sesh = sessionmaker(engine)()
+    regions = region_wkts
+    local_stats = use_local_stats
+    mask_cache = cache_dir
+
+# returns a boolean array the shape of the grid, True for each cell the WKT
+# (multi)polygon touches at all, not just those whose centres are in it.
+# This is the all-touched rasterization the stats API selects cells with, so
+# both find the same cells. Raises ValueError if the grid isn't regular.
+def rasterize(wkt, lats, lons):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    lons = np.where(lons > 180, lons - 360, lons)
+    for axis in (lats, lons):
+        # coordinates are often float32, so steps only agree to a fraction
+        # of their size
+        if len(axis) < 2 or not np.allclose(np.diff(axis), axis[1] - axis[0],
+                                            rtol=0, atol=abs(axis[1] - axis[0]) * 1e-3):
+            raise ValueError("grid is not regular")
+    dlat = lats[1] - lats[0]
+    dlon = lons[1] - lons[0]
+    transform = Affine(dlon, 0, lons[0] - dlon / 2, 0, dlat, lats[0] - dlat / 2)
+    return features.rasterize([shapely.wkt.loads(wkt)], out_shape=(len(lats), len(lons)),
+                              transform=transform, all_touched=True, fill=0,
+                              default_value=1, dtype="uint8").astype(bool)
+
+# region masks, keyed by a hash of the grid's coordinates and a hash of the
+# region's WKT. Most datasets share a few grids, so each mask is only found
+# once, and is saved to the mask cache directory, if there is one. Keys end
+# in "_touched", so masks saved by older versions, which only selected
+# cells whose centres were in the region, aren't reused.
+masks = {}
+
+def region_mask(wkt, lats, lons):
+    grid = hashlib.md5()
+    grid.update(np.asarray(lats, dtype=np.float64).tobytes())
+    grid.update(np.asarray(lons, dtype=np.float64).tobytes())
+    key = "{}_{}_touched".format(grid.hexdigest(), hashlib.md5(wkt.encode()).hexdigest())
+    if key not in masks:
+        path = os.path.join(mask_cache, "{}.npy".format(key)) if mask_cache else None
+        if path and os.path.exists(path):
+            masks[key] = np.load(path)
+        else:
+            masks[key] = rasterize(wkt, lats, lons)
+            if path:
+                # several workers may find the same mask; each writes its
+                # own temporary file and moves it into place.
+                fd, tmp = tempfile.mkstemp(dir=mask_cache, suffix=".npy")
+                with os.fdopen(fd, "wb") as tmpfile:
+                    np.save(tmpfile, masks[key])
+                os.replace(tmp, path)
+    return masks[key]
+
+# reduces an array of (timestep, cell) values to a list of the stats the
+# stats API would return for each timestep. Cells with no data are NaN and
+# are left out; a timestep with no data at all gets NaN for everything.
+def summarize(values, units):
+    numsteps = values.shape[0]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mins = np.nanmin(values, axis=1) if values.size else np.full(numsteps, np.nan)
+        maxes = np.nanmax(values, axis=1) if values.size else np.full(numsteps, np.nan)
+        means = np.nanmean(values, axis=1)
+        medians = np.nanmedian(values, axis=1)
+        stdevs = np.nanstd(values, axis=1)
+    ncells = np.count_nonzero(~np.isnan(values), axis=1)
+
+    return [{
+        "min": float(mins[i]),
+        "max": float(maxes[i]),
+        "mean": float(means[i]),
+        "median": float(medians[i]),
+        "stdev": float(stdevs[i]),
+        "ncells": int(ncells[i]),
+        "units": units
+        } for i in range(numsteps)]
+
+# the same results as the stats API, calculated from the dataset's file
+# using the cached region masks. All timesteps are read at once, from the
+# block of the grid all the regions are in, and each region's cells are
+# taken from that block. Returns a dictionary of region names to lists of
+# stats for each timestep, or None if the file's layout or grid can't be
+# handled here and the stats API should be used instead.
+def calculate_stats(nc, v, numsteps, regions):
+    variable = nc.variables[v]
+    # the block is read as (time, lat, lon), with the grid described by
+    # coordinate variables named after the lat and lon dimensions
+    if variable.ndim != 3 or variable.dimensions[0] != "time":
+        return None
+    lat_dim, lon_dim = variable.dimensions[1:]
+    for dim, names, axis in ((lat_dim, ("lat", "latitude"), "north"),
+                             (lon_dim, ("lon", "longitude"), "east")):
+        if dim not in nc.variables or nc.variables[dim].dimensions != (dim,):
+            return None
+        units = getattr(nc.variables[dim], "units", "")
+        if dim not in names and units not in ("degrees_{}".format(axis), "degree_{}".format(axis)):
+            return None
+    lats = nc.variables[lat_dim][:]
+    lons = nc.variables[lon_dim][:]
+    try:
+        masks = {name: region_mask(wkt, lats, lons) for name, wkt in regions}
+    except ValueError:
+        return None
+
+    union = np.logical_or.reduce(list(masks.values()))
+    rows = np.flatnonzero(union.any(axis=1))
+    cols = np.flatnonzero(union.any(axis=0))
+    if rows.size == 0:
+        return {name: summarize(np.full((numsteps, 0), np.nan), variable.units) for name in masks}
+    block = variable[:numsteps, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    # as floats, so missing values can be NaN even in integer variables
+    block = np.ma.filled(np.ma.masked_invalid(block.astype(np.float64)), np.nan)
+
+    all_stats = {}
+    for name, mask in masks.items():
+        values = block[:, mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]]
+        all_stats[name] = summarize(values, variable.units)
+    return all_stats
+
+# returns a dictionary of region names to lists of stats for each timestep
+# of one variable of a dataset, calculated locally if use_local is set and
+# the file's grid allows it and the file can be read here, or by calling
+# the stats API.
+def region_stats(ds_id, v, numsteps, task_wkts, use_local):
+    all_stats = None
+    if use_local:
+        filename = sesh.query(DataFile.filename).filter(DataFile.unique_id == ds_id).scalar()
+        if filename is None:
+            print("WARNING: no file recorded for {}; using the stats API".format(ds_id))
+        else:
+            try:
+                with Dataset(filename, "r") as nc:
+                    all_stats = calculate_stats(nc, v, numsteps, task_wkts)
+            except OSError as e:
+                print("WARNING: can't read the file of {} ({}); using the stats API".format(ds_id, e))
+            else:
+                if all_stats is None:
+                    print("WARNING: can't calculate {} {} locally; using the stats API".format(ds_id, v))
+    if all_stats is None:
+        all_stats = {name: [stats(sesh, ds_id, "{}".format(i), wkt, v)[ds_id] for i in range(numsteps)]
+                     for name, wkt in task_wkts}
+    return all_stats
+
+# calculates the stats of one variable of a dataset in one region both
+# locally and with the stats API, and returns a description of each stat
+# that differs between them.
+def compare_stats(ds_id, v, numsteps, region, wkt):
+    local = region_stats(ds_id, v, numsteps, [(region, wkt)], True)[region]
+    api = region_stats(ds_id, v, numsteps, [(region, wkt)], False)[region]
+    differences = []
+    for i in range(numsteps):
+        for stat in ['ncells', 'min', 'max', 'mean', 'median', 'stdev']:
+            if not np.isclose(local[i][stat], api[i][stat], rtol=1e-5, equal_nan=True):
+                differences.append("{} {} {} timestep {}: {} is {} locally, {} from the API".format(
+                    region, ds_id, v, i, stat, local[i][stat], api[i][stat]))
+    return differences
+
+# calls the stats API for each timestep of each of the task's variables
+# of a dataset, in each of the regions that variable needs, and returns a
+# CSV row for each call, and the (region, dataset, variable) of each region
+# with no cells in the dataset's grid, which get no rows. The dataset's
+# metadata is fetched once for all of them.
+def calculate_rows(task):
+    ds_id, ds, climatology, variable_regions = task
+    timescale = ds["timescale"]
+    numsteps = timesteps[timescale]
+
+    #this is really kludgy. Don't extract metadata from filenames!
+    op = "stdev" if "ClimSD" in ds_id else "mean"
+
+    m = metadata(sesh, ds_id)
+
+    rows = []
+    empty = []
+    for v, task_regions in variable_regions:
+        task_wkts = [(name, wkt) for name, wkt in regions if name in task_regions]
+        all_stats = region_stats(ds_id, v, numsteps, task_wkts, local_stats)
+        # a region with no cells in the dataset's grid has no stats to
+        # store; p2a would only get NaNs
+        for region, _ in task_wkts:
+            if all(s["ncells"] == 0 for s in all_stats[region]):
+                print("WARNING: {} has no cells in {} {}; skipped".format(region, ds_id, v))
+                empty.append((region, ds_id, v))
+        task_wkts = [(name, wkt) for name, wkt in task_wkts if (name, ds_id, v) not in empty]
+        rows.extend(variable_rows(ds_id, ds, v, climatology, op, m, task_wkts, all_stats))
+    return rows, empty
+
+# returns the CSV rows for one variable of a dataset in each region
+def variable_rows(ds_id, ds, v, climatology, op, m, task_wkts, all_stats):
+    timescale = ds["timescale"]
+    rows = []
+    for region, _ in task_wkts:
+        for i in range(timesteps[timescale]):
+            s = all_stats[region][i]
+            rows.append({
+                'unique_id': ds_id, 
+                'model': ds["model_id"],
+                'scenario': ds["experiment"],
+                'climatology': climatology, 
+                'start_date': ds["start_date"], 
+                'end_date': ds["end_date"], 
+                'variable': v,
+                'region': region,
+                'timescale': timescale,
+                'timeidx': i,
+                'timestamp': m[ds_id]["times"][i],
+                "op": op,
+                "modtime": ds["modtime"],
+                "min": s["min"],
+                'max': s["max"],
+                'mean': s["mean"],
+                'median': s["median"],
+                'stdev': s["stdev"], 
+                'ncells': s["ncells"],
+                'units': s["units"],
+                'access_time': date.today()
+                })
+    return rows
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser("Precalculate selected regional variables and output into a CSV")
+    parser.add_argument('-n', '--names', help='a csv matching region names with geoserver names')
+    parser.add_argument('-p', '--polygons', help='a csv describing regions from a geoserver')
+    parser.add_argument('-x', '--region_index', help='a region index made by index-regions.py, used instead of the names and polygons files')
+    parser.add_argument('-m', '--multimeta', help='dataset metadata obtained from PCEX /multimeta')
+    parser.add_argument('-r', '--region', help='the region to precalculate, a comma-separated list of regions, or "all"')
+    parser.add_argument('-t', '--tasmean', help='calculate tasmean from tasmin and tasmax',
+                        action='store_const', const=True, default=False)
+    parser.add_argument('-f', '--ffd', help='calculate frost free days from frost days', 
+                        action='store_const', const=True, default=False)
+    parser.add_argument('-b', '--baseline', default=False, help='YYYY,model include a historical baseline')
+    parser.add_argument('-d', '--dsn', help='connection string for a modelmeta database')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of worker processes making stats calls (default 1)')
+    parser.add_argument('--max_connections', type=int, help='most database connections to use at once; limits the number of workers')
+    parser.add_argument('-l', '--local_stats', action='store_true', help='calculate stats from the netCDF files in this script instead of with the stats API')
+    parser.add_argument('--mask_cache', help='directory to save region masks in for --local_stats, to be reused by later runs')
+    parser.add_argument('-c', '--check', type=int, metavar='N', help='instead of writing CSVs, calculate N (dataset, region) pairs both locally and with the stats API, and fail if they differ')
+    parser.add_argument('-i', '--incremental', action='store_true', help="reuse rows from each region's existing CSV for datasets that haven't changed since")
+
+    args = parser.parse_args()
+
+    # every worker holds one database connection
+    workers = args.workers
+    if args.max_connections:
+        workers = max(1, min(workers, args.max_connections))
+
+    if args.mask_cache:
+        os.makedirs(args.mask_cache, exist_ok=True)
+
+    derived = []
+    if args.tasmean:
+        derived.append("tasmean")
+    if args.ffd:
+        derived.append("ffd")
+    for name in derived:
+        for v in derived_variables[name]["inputs"]:
+            if v not in variables:
+                raise Exception("Cannot calculate {} without {}".format(name, v))
+    derived_inputs = {v for name in derived for v in derived_variables[name]["inputs"]}
         
-        files = 0
-        rows = 0
+    if args.baseline:
+        # this argument allows precalculation of data to serve as a historical
+        # baseline - one single model, one single time period - seperately from
+        # the other specified time periods.
+        baseline_datasets = 0
+        baseline_clim = standard_climo_years[args.baseline.split(',')[0]]
+        baseline_model = args.baseline.split(',')[1]
+        print("historical baseline years: {} model: {}".format(baseline_clim, baseline_model))
+
+    # look up the names of the regions
+    if args.region_index:
+        index = sqlite3.connect(args.region_index)
+        all_regions = [r for (r,) in index.execute("SELECT parameter FROM regions ORDER BY position")]
+    else:
+        with open(args.names) as region_names:
+            names_csv = list(csv.DictReader(region_names, quotechar="'"))
+        all_regions = [row['parameter'] for row in names_csv]
+    if args.region == "all":
+        # a region's output file is named after it, so skip any region
+        # whose name can't be a filename.
+        region_list = []
+        for r in all_regions:
+            if os.sep in r:
+                print("skipping region {}: not usable as a filename".format(r))
+            elif r not in region_list:
+                region_list.append(r)
+    else:
+        region_list = args.region.split(",")
+    
+    # acquire dataset metadata
+    with open(args.multimeta) as multimeta:
+        datasets = json.load(multimeta)
+
+    # fetch the WKT for each region.
+    if args.region_index:
+        region_wkts = []
+        for r in region_list:
+            found = index.execute("SELECT wkt FROM regions WHERE parameter = ?", (r,)).fetchone()
+            if not found:
+                raise Exception("Value not found: parameter: {}".format(r))
+            region_wkts.append((r, found[0]))
+        index.close()
+    else:
+        geo_regions = [find_row_match(names_csv, 'parameter', r)['english_na'] for r in region_list]
+        with open(args.polygons) as regions:
+            region_csv = list(csv.DictReader(regions))
+        region_wkts = [(r, find_row_match(region_csv, "english_na", g)["the_geom"])
+                       for r, g in zip(region_list, geo_regions)]
+    print("calculating {} regions".format(len(region_list)))
+
+    # with --incremental, load the rows from the last run, keyed by dataset,
+    # variable, and timestep. Derived rows are not kept; they're derived again
+    # from their inputs.
+    # Each CSV has an engine file beside it saying whether its rows came from
+    # the stats API or --local_stats. Rows are only carried forward into a
+    # run with the same engine, so a CSV never mixes the two.
+    # Datasets with no cells in a region have no rows in its CSV; they are
+    # listed, with their modtimes, in an "empty" file beside it instead, so
+    # they aren't calculated again either.
+    engine = "local" if args.local_stats else "api"
+    previous = {r: {} for r in region_list}
+    previous_empty = {r: {} for r in region_list}
+    if args.incremental:
+        for r in region_list:
+            if os.path.exists('{}.csv'.format(r)):
+                previous_engine = None
+                if os.path.exists('{}.csv.engine'.format(r)):
+                    with open('{}.csv.engine'.format(r)) as engine_file:
+                        previous_engine = engine_file.read().strip()
+                if previous_engine != engine:
+                    print("{}: existing rows were calculated with {}, not {}; recalculating all of them".format(
+                        r, previous_engine or "an unrecorded engine", engine))
+                    continue
+                with open('{}.csv'.format(r)) as old:
+                    for row in csv.DictReader(old):
+                        if row['unique_id'] != "null":
+                            row['timeidx'] = int(row['timeidx'])
+                            for att in ['min', 'max', 'mean', 'median', 'stdev']:
+                                row[att] = float(row[att])
+                            previous[r][(row['unique_id'], row['variable'], row['timeidx'])] = row
+                if os.path.exists('{}.csv.empty'.format(r)):
+                    with open('{}.csv.empty'.format(r)) as old:
+                        for row in csv.DictReader(old):
+                            previous_empty[r][(row['unique_id'], row['variable'])] = row['modtime']
+        print("loaded {} rows from previous runs".format(sum(len(p) for p in previous.values())))
+
+    # There are two separate sets of filters for precalculating datasets
+    # For projected datasets, they must match the variable, climatology,
+    # scenario, models, and scenarios given in the lists at the beginning of
+    # the script. Each variable of each matching dataset is a task for the
+    # workers, for every region that doesn't have up to date rows for it.
+    tasks = []
+    carried = []
+    empty = {r: [] for r in region_list}
+    files = 0
+    for ds_id in datasets:
+        ds = datasets[ds_id]
         
-        for ds_id in datasets:
-            ds = datasets[ds_id]
-            
-            # There are two separate sets of filters for precalculating datasets
-            # For projected datasets, they must match the variable, climatology,
-            # scenario, models, and scenarios given in the lists at the beginning of
-            # the script
-            
-            #see whether this particular dataset falls within the desired parameters
-            valid_var = False
-            data_vars = ds["variables"]
-            for v in variables:
-                if v in data_vars:
-                    valid_var = True
-                    
-            valid_clims = False
-            start = year_from_timestring(ds["start_date"])
-            end = year_from_timestring(ds["end_date"])
-            for c in climatologies:
-                if start < c and end > c:
-                    climatology = c
-                    valid_clims = True
-            
-            valid_model = ds["model_id"] in models
-            
-            valid_scen = ds["experiment"] in scenarios
-            
-            valid_projection = valid_var and valid_clims and valid_model and valid_scen
-            
-            # optional baseline datasets are only precalculated if the --baseline argument
-            # is provided, and must match model and climatology from that argument.
-            valid_baseline = False
-            if args.baseline:
-                valid_baseline = (baseline_clim == (start, end) and
-                                ds["model_id"] == baseline_model and
-                                ds['experiment'] == "historical" and valid_var)
-                if valid_baseline:
-                    climatology = args.baseline.split(',')[0]
-            
-            if valid_projection or valid_baseline:
-                timescale = ds["timescale"]
-                numsteps = {"monthly": 12, "yearly": 1, "seasonal": 4}[timescale]
+        #see whether this particular dataset falls within the desired parameters
+        valid_var = False
+        data_vars = ds["variables"]
+        for v in variables:
+            if v in data_vars:
+                valid_var = True
                 
-                #this is really kludgy. Don't extract metadata from filenames!
-                op = "stdev" if "ClimSD" in ds_id else "mean"
-                
-                m = metadata(sesh, ds_id)
-            
-                for v in data_vars:
-                    for i in range(numsteps):
-                        s = stats(sesh, ds_id, "{}".format(i), wkt, v)[ds_id]
-                        row = {
-                            'unique_id': ds_id, 
-                            'model': ds["model_id"],
-                            'scenario': ds["experiment"],
-                            'climatology': climatology, 
-                            'start_date': ds["start_date"], 
-                            'end_date': ds["end_date"], 
-                            'variable': v,
-                            'region': args.region,
-                            'timescale': timescale,
-                            'timeidx': i,
-                            'timestamp': m[ds_id]["times"][i],
-                            "op": op,
-                            "modtime": ds["modtime"],
-                            "min": s["min"],
-                            'max': s["max"],
-                            'mean': s["mean"],
-                            'median': s["median"],
-                            'stdev': s["stdev"], 
-                            'ncells': s["ncells"],
-                            'units': s["units"],
-                            'access_time': date.today()
-                            }
-                        # if this data will be used to generate composite variables, save it
-                        if args.tasmean and v in ["tasmax", "tasmin"]:
-                            tasmean_data[v].append(row)
-                        if args.ffd and v == 'fdETCCDI':
-                            ffd_data.append(row)
-
-                        outcsv.writerow(row)
-                        rows += 1
-                files += 1
-        print("{}: {} rows from {} files calculated".format(args.region, rows, files))    
+        valid_clims = False
+        start = year_from_timestring(ds["start_date"])
+        end = year_from_timestring(ds["end_date"])
+        for c in climatologies:
+            if start < c and end > c:
+                climatology = c
+                valid_clims = True
+        
+        valid_model = ds["model_id"] in models
+        
+        valid_scen = ds["experiment"] in scenarios
+        
+        valid_projection = valid_var and valid_clims and valid_model and valid_scen
+        
+        # optional baseline datasets are only precalculated if the --baseline argument
+        # is provided, and must match model and climatology from that argument.
+        valid_baseline = False
+        if args.baseline:
+            valid_baseline = (baseline_clim == (start, end) and
+                            ds["model_id"] == baseline_model and
+                            ds['experiment'] == "historical" and valid_var)
+            if valid_baseline:
+                climatology = args.baseline.split(',')[0]
+        
+        if valid_projection or valid_baseline:
+            variable_regions = []
+            for v in data_vars:
+                task_regions = []
+                for r in region_list:
+                    old_rows = [previous[r].get((ds_id, v, i)) for i in range(timesteps[ds["timescale"]])]
+                    if all(old_rows) and all(row['modtime'] == ds["modtime"] for row in old_rows):
+                        carried.extend(old_rows)
+                    elif previous_empty[r].get((ds_id, v)) == ds["modtime"]:
+                        empty[r].append((ds_id, v))
+                    else:
+                        task_regions.append(r)
+                if task_regions:
+                    variable_regions.append((v, task_regions))
+            if variable_regions:
+                tasks.append((ds_id, ds, climatology, variable_regions))
+            files += 1
+
+    # check that the local stats match the stats API for a sample of
+    # datasets spread through the tasks, in a variety of regions
+    if args.check:
+        init_worker(args.dsn, region_wkts, True, args.mask_cache)
+        wkts = dict(region_wkts)
+        pairs = [(ds_id, ds, v, task_regions) for ds_id, ds, climatology, variable_regions in tasks
+                 for v, task_regions in variable_regions]
+        step = max(1, len(pairs) // args.check)
+        differences = []
+        for n, (ds_id, ds, v, task_regions) in enumerate(pairs[::step][:args.check]):
+            region = task_regions[n % len(task_regions)]
+            print("checking {} {} in {}".format(ds_id, v, region))
+            differences.extend(compare_stats(ds_id, v, timesteps[ds["timescale"]], region, wkts[region]))
+        for difference in differences:
+            print("MISMATCH: {}".format(difference))
+        if differences:
+            sys.exit("local stats differ from the stats API in {} values".format(len(differences)))
+        print("local stats match the stats API for {} datasets".format(len(pairs[::step][:args.check])))
+        sys.exit(0)
+
+    # each region has its own output file. It's written under a temporary
+    # name and moved into place when complete, so an interrupted run doesn't
+    # lose the rows an incremental run would have carried forward.
+    outfiles = {r: open('{}.csv.tmp'.format(r), 'w') for r in region_list}
+    outcsvs = {}
+    for r in region_list:
+        outcsvs[r] = csv.DictWriter(outfiles[r], fieldnames)
+        outcsvs[r].writeheader()
+    rows = {r: 0 for r in region_list}
+    carried_rows = {r: 0 for r in region_list}
+    input_rows = {r: {v: [] for v in derived_inputs} for r in region_list}
+
+    def write_rows(task_rows, task_empty=()):
+        for region, ds_id, v in task_empty:
+            empty[region].append((ds_id, v))
+        for row in task_rows:
+            v = row["variable"]
+            region = row["region"]
+            # if this data will be used to generate composite variables, save it
+            if v in derived_inputs:
+                input_rows[region][v].append(row)
+            outcsvs[region].writerow(row)
+            rows[region] += 1
+
+    write_rows(carried)
+    for row in carried:
+        carried_rows[row["region"]] += 1
+
+    if workers > 1:
+        with Pool(workers, init_worker, (args.dsn, region_wkts,
+                                         args.local_stats, args.mask_cache)) as pool:
+            for task_rows, task_empty in pool.imap(calculate_rows, tasks):
+                write_rows(task_rows, task_empty)
+    else:
+        init_worker(args.dsn, region_wkts, args.local_stats, args.mask_cache)
+        for task in tasks:
+            write_rows(*calculate_rows(task))
+
+    for region in region_list:
+        outcsv = outcsvs[region]
+        print("{}: {} rows from {} files calculated, {} carried forward, {} variables with no cells".format(
+            region, rows[region] - carried_rows[region], files, carried_rows[region], len(empty[region])))
     
-        #todo : think about ops!
-        if args.tasmean:
-            #go through collected tasmax and tasmin data, generate new tasmean rows
-            tasmeans = 0
-            for mx in tasmean_data["tasmax"]:
-                matches = 0
-                for mn in tasmean_data["tasmin"]:
-                    atts_match = True
-                    for att in ['model', 'scenario', 'climatology', 'timescale', 'timeidx', 'op']:
-                        if mx[att] != mn[att]:
-                            atts_match = False
-                    if atts_match:
-                        last_modified = mx["modtime"] if mx["modtime"] > mn["modtime"] else mn["modtime"]
-                        matches += 1
-                        tasmean_row = {
-                                'unique_id': "null", 
-                                'model': mx["model"],
-                                'scenario': mx["scenario"],
-                                'climatology': mx["climatology"], 
-                                'start_date': mx["start_date"], 
-                                'end_date': mx["end_date"], 
-                                'variable': "tasmean",
-                                'region': args.region,
-                                'timescale': mx["timescale"],
-                                'timeidx': mx["timeidx"],
-                                'timestamp': mx["timestamp"],
-                                "op": mx["op"],
-                                "modtime": last_modified,
-                                "min": (mx["min"] + mn["min"]) / 2,
-                                'max': (mx["max"] + mn["max"]) / 2,
-                                'mean': (mx["mean"] + mn["mean"]) / 2,
-                                'median': (mx["median"] + mn["median"]) / 2,
-                                'stdev': (mx["stdev"] + mn["stdev"]) / 2, 
-                                'ncells': mx["ncells"],
-                                'units': mx["units"],
-                                'access_time': date.today()
-                            }
-                        outcsv.writerow(tasmean_row)
-                        tasmeans += 1
-            
-            print("{}: {} tasmean values calculated, {} unmatched".format(args.region, tasmeans,
-                                                                          (len(tasmean_data["tasmax"])
-                                                                                  + len(tasmean_data["tasmin"]))
-                                                                          - tasmeans * 2))    
-            if args.ffd:
-                #go through collected fdETCCDI data, generate new ffd rows
-                ffd_rows = 0
-                for d in ffd_data:
-                    d["variable"] = "ffd"
-                    d["unique_id"] = "null"
-                    for v in ['min', 'max', 'mean', 'median']:
-                        d[v] = 365 - d[v]
-                    outcsv.writerow(d)
-                    ffd_rows += 1
-            print("{}: {} ffd values calculated".format(args.region, ffd_rows))
-
-    outfile.close()
+        for name in derived:
+            derived_rows, unmatched = derive_rows(name, derived_variables[name], input_rows[region])
+            for row in derived_rows:
+                outcsv.writerow(row)
+            print("{}: {} {} values calculated, {} unmatched".format(region, len(derived_rows), name, unmatched))
+        outfiles[region].close()
+        with open('{}.csv.empty.tmp'.format(region), 'w') as empty_file:
+            empty_csv = csv.DictWriter(empty_file, ['unique_id', 'variable', 'modtime'])
+            empty_csv.writeheader()
+            for ds_id, v in empty[region]:
+                empty_csv.writerow({'unique_id': ds_id, 'variable': v, 'modtime': datasets[ds_id]["modtime"]})
+        # the old engine file is removed before the CSV is replaced, so an
+        # interrupted run can't leave one describing the wrong rows
+        if os.path.exists('{}.csv.engine'.format(region)):
+            os.remove('{}.csv.engine'.format(region))
+        os.replace('{}.csv.tmp'.format(region), '{}.csv'.format(region))
+        os.replace('{}.csv.empty.tmp'.format(region), '{}.csv.empty'.format(region))
+        with open('{}.csv.engine'.format(region), 'w') as engine_file:
+            engine_file.write("{}\n".format(engine))
     
-print("done!")
+    print("done!")
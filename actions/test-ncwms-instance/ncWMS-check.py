@@ -1,12 +1,20 @@
 '''This script checks that an ncWMS instance is able to serve every file in a
-specific ensemble in a PCIC modelmeta database.'''
+specific ensemble in a PCIC modelmeta database.
+
+Files can be checked several at a time (--workers). Each worker thread keeps
+its own HTTP session, so connections to ncWMS are kept alive and reused.
+Requests that time out, can't connect, or get a 502, 503, or 504 response
+from a proxy in front of ncWMS are retried with increasing delays.'''
 
 import sys
 import os
+import threading
 import requests
 import xmltodict
-import collections
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 
@@ -24,6 +32,14 @@ parser.add_argument('-s', '--ncwms',
 parser.add_argument('-v', '--version', type=int, default=1, choices=[1,2],
                     help="ncWMS version format")
 parser.add_argument('-p', '--prefix', help="prefix to use (iff a dynamic ncWMS instance)")
+parser.add_argument('-w', '--workers', type=int, default=1,
+                    help="number of files to check at once (default 1)")
+parser.add_argument('-t', '--timeout', type=float, default=60,
+                    help="seconds to wait for ncWMS to respond to a request (default 60)")
+parser.add_argument('-r', '--retries', type=int, default=3,
+                    help="times to retry a request that timed out, failed to connect, or got a 502, 503, or 504 response (default 3)")
+parser.add_argument('-b', '--backoff', type=float, default=1,
+                    help="backoff factor in seconds: the first retry is immediate, then retries wait 2, 4, 8... times this, up to two minutes (default 1)")
 parser.add_argument('ensemble', help="name of data ensemble to check")
 
 
@@ -37,37 +53,53 @@ def parse_ncWMS_exception(xml):
             return ed['ServiceExceptionReport']['ServiceException']
         return None
     except:
-        raise("ncWMS did not return an XML response. Check your ncWMS URL")
-        
-
-# connect to the database
-engine = create_engine(args.dsn)
-Session = sessionmaker(bind=engine)
-sesh = Session()
-
-# get list of all variables in the ensemble
-query = sesh.query(DataFileVariable).join(EnsembleDataFileVariables, Ensemble).filter(Ensemble.name == args.ensemble)
-vars = [(
-        dfv.file.unique_id,
-        dfv.file.filename,
-        dfv.netcdf_variable_name,
-        dfv.range_min,
-        dfv.range_max,
-        dfv.variable_alias.standard_name
-    ) for dfv in query.all()]
-
-files = 0
-errors = 0
-error_files = set()
-
-for unique_id, filename, var_name, range_min, range_max, variable_standard_name in vars:
+        raise ValueError("ncWMS did not return an XML response. Check your ncWMS URL")
+
+# requests sessions aren't safe to share between threads, so each thread
+# gets its own, which keeps its connections to ncWMS open between requests.
+thread_data = threading.local()
+
+def get_session():
+    if not hasattr(thread_data, "session"):
+        retry = Retry(total=args.retries, backoff_factor=args.backoff,
+                      status_forcelist=[502, 503, 504], raise_on_status=False)
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(max_retries=retry))
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        thread_data.session = session
+    return thread_data.session
+
+def wms_request(request, params, messages):
+    '''makes a request to ncWMS. Returns the response if it succeeded, or
+    adds an error to messages and returns None if not.'''
+    try:
+        response = get_session().get('{}'.format(args.ncwms), params=params, timeout=args.timeout)
+    except requests.exceptions.RequestException as e:
+        messages.append("  ERROR: {} failed ({})".format(request, e))
+        return None
+    if response.status_code != 200:
+        try:
+            error = parse_ncWMS_exception(response.content)
+        except ValueError as e:
+            error = str(e)
+        messages.append("  ERROR: {} returned {} ({})".format(request, response.status_code,
+                                                        error if error else "unable to parse error"))
+        return None
+    messages.append("  {} call OK".format(request))
+    return response
+
+def check_file(var):
+    '''makes GetCapabilities, GetFeatureInfo, and GetMap requests for one
+    variable in a file. Returns the dataset's identification, the messages
+    to print about it, and the number of errors.'''
+    unique_id, filename, var_name, range_min, range_max, variable_standard_name = var
     # for a dynamic dataset, maps are called via a prefix and the filepath
     # for a static dataset, maps are called via unique_id.
     identification = "{}{}".format(args.prefix, filename) if args.prefix else unique_id
     style = "boxfill/default" if args.version == 1 else "default"
     
-    
-    print("Now checking {}".format(identification))
+    messages = ["Now checking {}".format(identification)]
+    errors = 0
     
     # make a GetCapabilities query on this dataset
     gc_params = {
@@ -76,23 +108,18 @@ for unique_id, filename, var_name, range_min, range_max, variable_standard_name
         "VERSION": "1.1.1",
         "DATASET": identification,
         }
-    response = requests.get('{}'.format(args.ncwms), params=gc_params)
-    
-    if response.status_code != 200:
-        error = parse_ncWMS_exception(response.content)
-        print("  ERROR: GetCapabilities returned {} ({})".format(response.status_code, 
-                                                        error if error else "unable to parse error"))
-        errors += 1
-        error_files.add(identification)
-    else:
-        print("  GetCapabilites call OK")
+    response = wms_request("GetCapabilities", gc_params, messages)
+    if response is None:
+        return identification, messages, 1
         
-        
-        # extract spatial and temporal extent from xml returned by GetCapabilities
-        # we'll need this for the other queries
+    # extract spatial and temporal extent from xml returned by GetCapabilities
+    # we'll need this for the other queries. A response that isn't XML, or
+    # doesn't describe a layer, is an error for this file rather than for the
+    # whole run.
+    try:
         cap_metadata = xmltodict.parse(response.content)
         layers = cap_metadata['WMT_MS_Capabilities']['Capability']['Layer']['Layer']['Layer']
-        if isinstance(layers, collections.OrderedDict):
+        if isinstance(layers, dict):
             # this dataset contains only one layer
             layer_metadata = layers
         elif isinstance(layers, list):
@@ -104,13 +131,8 @@ for unique_id, filename, var_name, range_min, range_max, variable_standard_name
             # Use the 0th one.
             layer_metadata = layers[0]
         else:
-            print("  ERROR: cannot parse GetCapabilities response")
-            errors += 1
-            error_files.add(identification)
-            continue
-        
-    
-    
+            raise ValueError("no layers found")
+
         #get spatial info: bounding box and SRS
         bounding_box = layer_metadata['BoundingBox']
         srs = bounding_box['@SRS']
@@ -119,67 +141,86 @@ for unique_id, filename, var_name, range_min, range_max, variable_standard_name
         maxx = bounding_box['@maxx']
         maxy = bounding_box['@maxy']
         bbox = "{},{},{},{}".format(minx, miny, maxx, maxy)
-    
+
         # get a valid timestamp
         default_timestamp = layer_metadata["Extent"]["@default"]
+    except Exception as e:
+        messages.append("  ERROR: cannot parse GetCapabilities response ({}: {})".format(
+            type(e).__name__, e))
+        return identification, messages, 1
+
+    # make a GetFeatureInfo query on this dataset
+    # build the query
+    gfi_params = {
+        "REQUEST": "GetFeatureInfo",
+        "SERVICE": "WMS",
+        "VERSION": "1.1.1",
+        "QUERY_LAYERS": "{}/{}".format(identification, var_name),
+        "LAYERS": "{}/{}".format(identification, var_name),
+        "WIDTH": 100,
+        "HEIGHT": 100,
+        "SRS": srs,
+        "BBOX": bbox,
+        "INFO_FORMAT": "text/xml",
+        "X": 50,
+        "Y": 50
+        }
+    if wms_request("GetFeatureInfo", gfi_params, messages) is None:
+        errors += 1
     
-        # make a GetFeatureInfo query on this dataset
-        # build the query
-        gfi_params = {
-            "REQUEST": "GetFeatureInfo",
-            "SERVICE": "WMS",
-            "VERSION": "1.1.1",
-            "QUERY_LAYERS": "{}/{}".format(identification, var_name),
-            "LAYERS": "{}/{}".format(identification, var_name),
-            "WIDTH": 100,
-            "HEIGHT": 100,
-            "SRS": srs,
-            "BBOX": bbox,
-            "INFO_FORMAT": "text/xml",
-            "X": 50,
-            "Y": 50
-            }
+    # make a GetMap query on this dataset
+    gm_params = {
+        "REQUEST": "GetMap",
+        "SERVICE": "WMS",
+        "VERSION": "1.1.1",
+        "LAYERS": "{}/{}".format(identification, var_name),
+        "TRANSPARENT": "true",
+        "STYLES": style,
+        "NUMCOLORBANDS": 254,
+        "SRS": srs,
+        "LOGSCALE": "false",
+        "FORMAT": "image/png",
+        "BBOX": bbox,
+        "WIDTH": 100,
+        "HEIGHT": 100,
+        "COLORSCALERANGE": "{},{}".format(range_min, range_max),
+        "TIME": default_timestamp
+        }
+    if wms_request("GetMap", gm_params, messages) is None:
+        errors += 1
     
-        response = requests.get('{}'.format(args.ncwms), params=gfi_params)
-        if response.status_code == 200:
-            print("  GetFeatureInfo call OK")
-        else:
-            error = parse_ncWMS_exception(response.content)
-            print("  ERROR: GetFeatureInfo returned {} ({})".format(response.status_code, 
-                                                        error if error else "unable to parse error"))
-            errors += 1
-            error_files.add(identification)
+    return identification, messages, errors
         
-        # make a GetMap query on this dataset
-        gm_params = {
-            "REQUEST": "GetMap",
-            "SERVICE": "WMS",
-            "VERSION": "1.1.1",
-            "LAYERS": "{}/{}".format(identification, var_name),
-            "TRANSPARENT": "true",
-            "STYLES": style,
-            "NUMCOLORBANDS": 254,
-            "SRS": srs,
-            "LOGSCALE": "false",
-            "FORMAT": "image/png",
-            "BBOX": bbox,
-            "WIDTH": 100,
-            "HEIGHT": 100,
-            "COLORSCALERANGE": "{},{}".format(range_min, range_max),
-            "TIME": default_timestamp
-            }
-
-        response = requests.get('{}'.format(args.ncwms), params=gm_params)
-        if response.status_code == 200:
-            print("  GetMap call OK")
-        else:
-            error = parse_ncWMS_exception(response.content)
-            print("  ERROR: GetMap returned {} ({})".format(response.status_code, 
-                                                        error if error else "unable to parse error"))
-            errors += 1
+
+# connect to the database
+engine = create_engine(args.dsn)
+Session = sessionmaker(bind=engine)
+sesh = Session()
+
+# get list of all variables in the ensemble
+query = sesh.query(DataFileVariable).join(EnsembleDataFileVariables, Ensemble).filter(Ensemble.name == args.ensemble)
+vars = [(
+        dfv.file.unique_id,
+        dfv.file.filename,
+        dfv.netcdf_variable_name,
+        dfv.range_min,
+        dfv.range_max,
+        dfv.variable_alias.standard_name
+    ) for dfv in query.all()]
+
+files = 0
+errors = 0
+error_files = set()
+
+# the messages about each file are printed together, in the same order as
+# the files, however many are being checked at once.
+with ThreadPoolExecutor(args.workers) as executor:
+    for identification, messages, file_errors in executor.map(check_file, vars):
+        print("\n".join(messages))
+        if file_errors:
+            errors += file_errors
             error_files.add(identification)
-        
-    files += 1
+        files += 1
 
 
 
@@ -187,7 +228,7 @@ print("----------------------------------------------------")
 print("FILE SUMMARY: checked {} files, {} errors found".format(files, errors))
 if errors > 0:
     print("Files with errors:")
-    for f in error_files:
+    for f in sorted(error_files):
         print("  {}".format(f))
         
 # GetLegendGraphic, as used by the PDP, does not specify a dataset, so we need
@@ -200,9 +241,7 @@ glg_params = {
     "NUMCOLORBANDS": 254,
     "PALETTE": "default"
     }
-    
-response = requests.get('{}'.format(args.ncwms), params=glg_params)
-if response.status_code == 200:
-    print("\nGetLegendGraphic call OK")
-else:
-    print("ERROR: GetLegendGraphic returned {}".format(response.status_code))
+
+messages = []
+wms_request("GetLegendGraphic", glg_params, messages)
+print("\n" + messages[0].strip())